@@ -0,0 +1,89 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+import os
+from collections import OrderedDict
+
+import discord
+
+import ccp
+import render
+
+class AvatarCache(object):
+    '''Avatars cut out and sized for image commands, keyed by
+    (user ID, avatar hash, size).
+
+    An avatar is downloaded and prepared once, then kept in an LRU of
+    `capacity` entries. With a `directory`, entries are also written
+    there and read back after a restart. A changed avatar has a new hash,
+    so stale entries are never served; on disk they are removed when the
+    user's new avatar is written.
+    '''
+    def __init__(self, web, renderer, capacity: int = 256, directory: str = None):
+        self.web = web
+        self.renderer = renderer
+        self.capacity = capacity
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._loading = {}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key: tuple) -> str:
+        return os.path.join(self.directory, '_'.join(map(str, key)) + '.png')
+
+    def _read(self, key: tuple) -> bytes:
+        try:
+            with open(self._path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: tuple, data: bytes):
+        prefix = f'{key[0]}_'
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.directory, name))
+
+        with open(self._path(key), 'wb') as file:
+            file.write(data)
+
+    def key(self, user: discord.abc.User, size: int = 512) -> tuple:
+        return user.id, user.avatar or f'default{user.default_avatar.value}', size
+
+    async def get(self, user: discord.abc.User, size: int = 512) -> bytes:
+        '''Returns the avatar of `user` as a `size` square PNG, masked to a circle.'''
+        key = self.key(user, size)
+        if (data := self._entries.get(key)) is not None:
+            self._entries.move_to_end(key)
+            return data
+
+        # Concurrent requests for one avatar share a download.
+        if (future := self._loading.get(key)) is None:
+            future = self._loading[key] = asyncio.ensure_future(self._load(user, key))
+            future.add_done_callback(lambda _: self._loading.pop(key, None))
+
+        data = await asyncio.shield(future)
+        self._entries[key] = data
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return data
+
+    async def _load(self, user: discord.abc.User, key: tuple) -> bytes:
+        loop = asyncio.get_event_loop()
+        if self.directory and (data := await loop.run_in_executor(None, self._read, key)):
+            return data
+
+        avatar = await self.web.get(str(user.avatar_url_as(static_format='png', size=1024)))
+        data = await self.renderer.render(render.prepare_avatar, avatar, key[2])
+
+        if self.directory:
+            try:
+                await loop.run_in_executor(None, self._write, key, data)
+            except OSError as err:
+                ccp.error(f'Failed to store avatar: {err}')
+        return data
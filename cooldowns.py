@@ -0,0 +1,176 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+import datetime
+import math
+import time
+
+import asyncpg
+
+import ccp
+
+# The wheel has _LEVELS levels of _SLOTS slots. A slot on level n spans
+# _SLOTS ** n seconds, so four levels cover about six months.
+_BITS = 6
+_SLOTS = 1 << _BITS
+_LEVELS = 4
+
+class Cooldowns(object):
+    '''Rate limits allowing `rate` uses per `per` seconds for each key.
+
+    As with discord.py cooldowns, the window starts at the first use. Every
+    key is kept only until its window ends. Keys are filed in a hierarchical
+    timing wheel by expiry, and catching up only visits the seconds in which
+    keys are due, so checks are O(1) and memory follows the active keys.
+
+    With a `name`, uses are saved to the cooldowns table by `save`, and
+    `load` reads back the windows that are still open.
+    '''
+    def __init__(self, rate: int, per: float, name: str = None):
+        self.rate = rate
+        self.per = per
+        self.name = name
+        self.loaded = asyncio.Event()
+        if not name:
+            self.loaded.set()
+
+        self._entries = {}
+        self._wheel = [[set() for _ in range(_SLOTS)] for _ in range(_LEVELS)]
+        self._tick = int(time.time())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _schedule(self, key: any, expires: float):
+        due = math.ceil(expires)
+        for lvl in range(_LEVELS):
+            if due - self._tick < _SLOTS << (_BITS * lvl) or lvl == _LEVELS - 1:
+                self._wheel[lvl][(due >> (_BITS * lvl)) & (_SLOTS - 1)].add(key)
+                return
+
+    def _next(self, now: int) -> int:
+        '''Returns the first tick up to `now` with keys due or to be spread
+        down a level, or `now` if there is none.
+        '''
+        tick = self._tick
+        mask = _SLOTS - 1
+        nxt = now
+        for d in range(1, min(_SLOTS, now - tick) + 1):
+            if self._wheel[0][(tick + d) & mask]:
+                nxt = tick + d
+                break
+
+        for lvl in range(1, _LEVELS):
+            span = 1 << (_BITS * lvl)
+            boundary = (tick // span + 1) * span
+            for _ in range(_SLOTS):
+                if boundary >= nxt:
+                    break
+                if self._wheel[lvl][(boundary >> (_BITS * lvl)) & mask]:
+                    nxt = boundary
+                    break
+                boundary += span
+        return nxt
+
+    def _rebuild(self, now: int):
+        '''Drops every key due by `now` and files the rest again.'''
+        for level in self._wheel:
+            for slot in level:
+                slot.clear()
+
+        self._tick = now
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > now}
+        for key, (expires, _) in self._entries.items():
+            self._schedule(key, expires)
+
+    def _advance(self, now: int):
+        '''Expires every key due up to `now`.
+        Seconds in which nothing is due are skipped, so an idle wheel catches
+        up in a few steps however long it was idle.
+        '''
+        if self._tick >= now:
+            return
+        if not self._entries or now - self._tick >= _SLOTS << (_BITS * (_LEVELS - 1)):
+            return self._rebuild(now)
+
+        while self._tick < now:
+            self._tick = tick = self._next(now)
+
+            # Once the lower levels have gone round, the next slot of
+            # the level above is spread over them.
+            for lvl in range(_LEVELS - 1, 0, -1):
+                if tick & ((1 << (_BITS * lvl)) - 1) == 0:
+                    slot = self._wheel[lvl][(tick >> (_BITS * lvl)) & (_SLOTS - 1)]
+                    keys = list(slot)
+                    slot.clear()
+                    for key in keys:
+                        if key in self._entries:
+                            self._schedule(key, self._entries[key][0])
+
+            slot = self._wheel[0][tick & (_SLOTS - 1)]
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                if (entry := self._entries.get(key)) is None:
+                    continue
+                if entry[0] <= tick:
+                    del self._entries[key]
+                else:
+                    self._schedule(key, entry[0])
+
+    def retry_after(self, key: any) -> float:
+        '''Returns the seconds until `key` may be used again, or 0.'''
+        now = time.time()
+        self._advance(int(now))
+        expires, count = self._entries.get(key, (0, 0))
+        return expires - now if expires > now and count >= self.rate else 0
+
+    def hit(self, key: any) -> float:
+        '''Uses `key` once if it is not limited.
+        Returns the seconds until it may be used again if it is, otherwise 0.
+        '''
+        now = time.time()
+        self._advance(int(now))
+        expires, count = self._entries.get(key, (0, 0))
+        if expires <= now:
+            expires, count = now + self.per, 0
+            self._schedule(key, expires)
+        elif count >= self.rate:
+            return expires - now
+
+        self._entries[key] = expires, count + 1
+        return 0
+
+    async def load(self, pool: asyncpg.pool.Pool):
+        '''Reads the windows still open from the cooldowns table and prunes the rest.
+        If that fails, `loaded` is still set and only uses from now on count.
+        '''
+        now = datetime.datetime.utcnow()
+        try:
+            async with pool.acquire() as con:
+                query = 'SELECT key, expires_at, count FROM cooldowns WHERE name = $1 AND expires_at > $2'
+                records = await con.fetch(query, self.name, now)
+                await con.execute('DELETE FROM cooldowns WHERE name = $1 AND expires_at <= $2', self.name, now)
+        except Exception as err:
+            ccp.error(f'Failed to load {self.name} cooldowns: {err!r}')
+            records = []
+
+        for key, expires_at, count in records:
+            expires = expires_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+            if key not in self._entries:
+                self._entries[key] = expires, count
+                self._schedule(key, expires)
+
+        self.loaded.set()
+
+    async def save(self, pool: asyncpg.pool.Pool, key: int):
+        '''Writes the window of `key` to the cooldowns table.'''
+        if (entry := self._entries.get(key)) is None:
+            return
+
+        expires, count = entry
+        expires_at = datetime.datetime.utcfromtimestamp(expires)
+        async with pool.acquire() as con:
+            query = ('INSERT INTO cooldowns (name, key, expires_at, count) VALUES ($1, $2, $3, $4) '
+                     'ON CONFLICT (name, key) DO UPDATE SET expires_at = EXCLUDED.expires_at, count = EXCLUDED.count')
+            await con.execute(query, self.name, key, expires_at, count)
@@ -0,0 +1,188 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncpg
+
+import ccp
+import utils
+
+# Every migration runs once, in order, and is recorded in schema_version.
+# Migrations that run outside a transaction must be safe to run again,
+# since a failure part way leaves them unrecorded.
+_migrations = []
+
+# Tables and the primary keys declared in their schemas
+_KEYS = {
+    'guilds': 'guild_id',
+    'users': 'user_id',
+    'members': 'user_id, guild_id',
+    'role_menus': 'guild_id, message_id',
+    'ranks': 'guild_id',
+    'stars': 'message_id',
+    'reminders': 'user_id, time',
+    'tags': 'guild_id, name'
+}
+
+# Tables cached with a snapshot, which needs their changes tracked
+_TRACKED = ('guilds', 'role_menus', 'ranks', 'reminders', 'tags', 'modlog')
+
+def migration(transaction: bool = True):
+    '''Registers the decorated coroutine as the next migration.
+    Its docstring is recorded as the name of the migration.
+    '''
+    def decorator(func):
+        _migrations.append((func, transaction))
+        return func
+    return decorator
+
+async def create_index(con: asyncpg.Connection, name: str, definition: str, unique: bool = False):
+    '''Builds an index without locking writes to the table.
+    An invalid index left by a failed build is dropped and built again.
+    '''
+    query = 'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)'
+    if (valid := await con.fetchval(query, name)) is False:
+        await con.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    elif valid:
+        return
+
+    await con.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY {name} ON {definition}')
+
+@migration()
+async def create_tables(con: asyncpg.Connection):
+    '''Create tables'''
+    for table, schema in (('guilds', utils.guilds_schema), ('users', utils.users_schema),
+                          ('members', utils.members_schema), ('role_menus', utils.role_menus_schema),
+                          ('ranks', utils.ranks_schema), ('stars', utils.stars_schema),
+                          ('reminders', utils.reminders_schema), ('tags', utils.tags_schema),
+                          ('modlog', utils.modlog_schema)):
+        await con.execute(f'CREATE TABLE IF NOT EXISTS {table} ({schema})')
+
+@migration(transaction=False)
+async def add_primary_keys(con: asyncpg.Connection):
+    '''Add primary keys to tables created without them'''
+    for table, pk in _KEYS.items():
+        query = 'SELECT 1 FROM pg_constraint WHERE conrelid = $1::regclass AND contype = \'p\''
+        if await con.fetchval(query, table):
+            continue
+
+        # Keep the most recently written row of any duplicates.
+        condition = ' AND '.join(f'a.{k} = b.{k}' for k in pk.split(', '))
+        await con.execute(f'DELETE FROM {table} a USING {table} b WHERE a.ctid < b.ctid AND {condition}')
+
+        # The key is built without blocking writes, then attached in an instant.
+        await create_index(con, f'{table}_pkey', f'{table} ({pk})', unique=True)
+        await con.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY USING INDEX {table}_pkey')
+
+@migration()
+async def track_changes(con: asyncpg.Connection):
+    '''Track changes to snapshotted tables'''
+    # Deleted rows are kept as tombstones until the next snapshot no longer needs them.
+    await con.execute('''
+        CREATE TABLE IF NOT EXISTS tombstones (tbl text, old jsonb, deleted_at timestamp DEFAULT now());
+        CREATE INDEX IF NOT EXISTS tombstones_tbl_deleted_at_idx ON tombstones (tbl, deleted_at);
+        CREATE OR REPLACE FUNCTION track_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO tombstones (tbl, old) VALUES (TG_TABLE_NAME, to_jsonb(OLD));
+                RETURN OLD;
+            END IF;
+            NEW.updated_at = now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    for table in _TRACKED:
+        await con.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at timestamp DEFAULT now()')
+        await con.execute(f'CREATE INDEX IF NOT EXISTS {table}_updated_at_idx ON {table} (updated_at)')
+        await con.execute(f'DROP TRIGGER IF EXISTS {table}_track ON {table}')
+        await con.execute(f'CREATE TRIGGER {table}_track BEFORE INSERT OR UPDATE OR DELETE ON {table} '
+                          'FOR EACH ROW EXECUTE PROCEDURE track_change()')
+
+@migration(transaction=False)
+async def add_indexes(con: asyncpg.Connection):
+    '''Index leaderboards, mutes, the modlog and tag search'''
+    await con.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    await create_index(con, 'members_guild_id_xp_idx', 'members (guild_id, xp DESC)')
+    await create_index(con, 'members_muted_idx', 'members (muted) WHERE muted IS NOT NULL')
+    await create_index(con, 'modlog_user_id_guild_id_time_idx', 'modlog (user_id, guild_id, time DESC)')
+    await create_index(con, 'tags_name_trgm_idx', 'tags USING gin (name gin_trgm_ops)')
+
+@migration()
+async def create_role_jobs(con: asyncpg.Connection):
+    '''Create the bulk role job table'''
+    await con.execute('CREATE TABLE IF NOT EXISTS role_jobs ('
+                      'job_id serial PRIMARY KEY, '
+                      'guild_id bigint, '
+                      'channel_id bigint, '
+                      'message_id bigint, '
+                      'kind text, '
+                      'role_id bigint, '
+                      'position bigint DEFAULT 0, '
+                      'done int DEFAULT 0, '
+                      'total int DEFAULT 0, '
+                      'status text DEFAULT \'running\', '
+                      'created_at timestamp DEFAULT now())')
+    await con.execute('CREATE INDEX IF NOT EXISTS role_jobs_status_idx ON role_jobs (status)')
+
+@migration()
+async def create_cooldowns(con: asyncpg.Connection):
+    '''Create the persistent cooldown table'''
+    await con.execute('CREATE TABLE IF NOT EXISTS cooldowns ('
+                      'name text, '
+                      'key bigint, '
+                      'expires_at timestamp, '
+                      'count int, '
+                      'PRIMARY KEY (name, key))')
+    await con.execute('CREATE INDEX IF NOT EXISTS cooldowns_name_expires_at_idx ON cooldowns (name, expires_at)')
+
+@migration()
+async def create_timers(con: asyncpg.Connection):
+    '''Move reminders and mutes to the timer table'''
+    await con.execute('CREATE TABLE IF NOT EXISTS timers ('
+                      'kind text, '
+                      'key text, '
+                      'due_at timestamp, '
+                      'payload jsonb, '
+                      'PRIMARY KEY (kind, key))')
+    await con.execute('CREATE INDEX IF NOT EXISTS timers_due_at_idx ON timers (due_at)')
+
+    await con.execute('INSERT INTO timers (kind, key, due_at, payload) '
+                      'SELECT \'reminder\', concat_ws(\':\', user_id, channel_id, extract(epoch FROM time)), time, '
+                      'json_build_object(\'user_id\', user_id, \'channel_id\', channel_id, \'reminder\', reminder) '
+                      'FROM reminders ON CONFLICT DO NOTHING')
+    await con.execute('DELETE FROM reminders')
+
+    # Mutes without a limit were stored with the time they were made, and were
+    # lifted on restart like any other. They are carried over the same way.
+    await con.execute('INSERT INTO timers (kind, key, due_at, payload) '
+                      'SELECT \'mute\', concat_ws(\':\', user_id, guild_id), muted, \'null\'::jsonb '
+                      'FROM members WHERE muted IS NOT NULL ON CONFLICT DO NOTHING')
+
+async def migrate(pool: asyncpg.pool.Pool):
+    '''Applies every migration newer than the database.
+    An advisory lock keeps concurrent instances from migrating at once.
+    '''
+    async with pool.acquire() as con:
+        await con.execute('SELECT pg_advisory_lock(hashtext(\'schema_version\'))')
+        try:
+            await con.execute('CREATE TABLE IF NOT EXISTS schema_version '
+                              '(version int PRIMARY KEY, name text, applied_at timestamp DEFAULT now())')
+            current = await con.fetchval('SELECT coalesce(max(version), 0) FROM schema_version')
+
+            for version, (func, transaction) in enumerate(_migrations[current:], current+1):
+                name = func.__doc__
+                ccp.log('Migrating', f'{version}: {name}')
+                try:
+                    if transaction:
+                        async with con.transaction():
+                            await func(con)
+                            await con.execute('INSERT INTO schema_version (version, name) VALUES ($1, $2)', version, name)
+                    else:
+                        await func(con)
+                        await con.execute('INSERT INTO schema_version (version, name) VALUES ($1, $2)', version, name)
+                except asyncpg.PostgresError as err:
+                    ccp.error(f'Migration {version} ({name}) failed: {err}')
+                    raise
+        finally:
+            await con.execute('SELECT pg_advisory_unlock(hashtext(\'schema_version\'))')
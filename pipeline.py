@@ -0,0 +1,89 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import time
+import traceback
+
+import discord
+
+import ccp
+
+# Order of the built-in stages. Lower runs first.
+AUTOMOD = 0
+XP = 10
+BIRTHDAY = 20
+COMMANDS = 30
+
+class Context(object):
+    '''Everything the stages share about a message, worked out once.
+
+    `user` and `member` are the cached records of the author, or None for
+    bots. `member` is also None outside of guilds.
+    '''
+    __slots__ = ('msg', 'author', 'guild', 'channel', 'prefix', 'is_command', 'suppressed', 'user', 'member')
+
+    def __init__(self, msg: discord.Message, prefix: str, suppressed: bool):
+        self.msg = msg
+        self.author = msg.author
+        self.guild = msg.guild
+        self.channel = msg.channel
+        self.prefix = prefix
+        self.is_command = msg.content.startswith(prefix)
+        self.suppressed = suppressed
+        self.user = None
+        self.member = None
+
+class Pipeline(object):
+    '''Passes every message through the registered stages in order.
+
+    A stage is a coroutine taking a `Context`. If it returns True the
+    message is consumed and the remaining stages are skipped. The time
+    spent in each stage is counted and can be read from `stats`.
+    '''
+    def __init__(self, bot):
+        self.bot = bot
+        self._stages = []
+        self.stats = {}
+
+    def register(self, name: str, func, order: int):
+        '''Adds a stage, replacing any stage of the same name.'''
+        self.unregister(name)
+        self._stages.append((order, name, func))
+        self._stages.sort(key=lambda stage: stage[0])
+        self.stats.setdefault(name, [0, 0.0, 0.0])
+
+    def unregister(self, name: str):
+        self._stages = [stage for stage in self._stages if stage[1] != name]
+
+    async def _context(self, msg: discord.Message) -> Context:
+        guild = msg.guild
+        guilds_ = self.bot.guilds_
+        prefix = guilds_[guild.id]['prefix'] if guild else guilds_.default['prefix']
+        suppressed = self.bot.suppressed.get(msg.author) == msg.channel
+        ctx = Context(msg, prefix, suppressed)
+
+        if not msg.author.bot:
+            ctx.user = await self.bot.users_.fetch(msg.author.id, create=True)
+            if guild:
+                ctx.member = await self.bot.members.fetch((msg.author.id, guild.id), create=True)
+
+        return ctx
+
+    async def dispatch(self, msg: discord.Message):
+        ctx = await self._context(msg)
+        for _, name, func in self._stages:
+            start = time.perf_counter()
+            try:
+                consumed = await func(ctx)
+            except Exception:
+                ccp.error(f'Stage {name} failed')
+                traceback.print_exc()
+                consumed = False
+
+            elapsed = time.perf_counter() - start
+            stats = self.stats[name]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+            if consumed:
+                break
@@ -6,22 +6,30 @@ from discord import Embed
 from discord.ext import commands
 
 import ccp
+import pipeline
 from utils import Emoji
 
 class Automod(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        bot.pipeline.register('automod', self.check, pipeline.AUTOMOD)
 
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        if not msg.guild:
-            return
+    def cog_unload(self):
+        self.bot.pipeline.unregister('automod')
 
-        member = msg.author
-        guild = msg.guild
+    async def check(self, ctx: pipeline.Context) -> bool:
+        '''Deletes invite links, muting whoever sent them.
+        Returns True if the message was deleted.
+        '''
+        if not ctx.guild:
+            return False
+
+        msg = ctx.msg
+        member = ctx.author
+        guild = ctx.guild
 
         if not self.bot.guilds_[guild.id]['automod']:
-            return
+            return False
 
         pattern = r'(https?:\/\/)?(www\.)?(discord\.(gg|io|me|li|sg)|discordapp\.com\/invite)\/.+[a-z]'
         match = re.search(pattern, msg.content)
@@ -30,16 +38,17 @@ class Automod(commands.Cog):
 
             perms = member.guild_permissions
             if perms.kick_members or perms.ban_members:
-                return
+                return False
 
             await msg.delete()
-            
-            muted = self.bot.members[member.id, guild.id]['muted']
-            if not muted:
+
+            # Bots have no record in the context.
+            record = ctx.member or await self.bot.members.fetch((member.id, guild.id), create=True)
+            if not record['muted']:
                 reason = 'Sent an invite URL'
                 await member.add_roles(mute_role, reason=reason)
 
-                await self.bot.members.update((member.id, guild.id), 'muted', str(datetime.datetime.utcnow()))
+                await self.bot.members.update((member.id, guild.id), 'muted', datetime.datetime.utcnow())
                 
                 embed = Embed(description=f'**{Emoji.mute} You have been muted by `Automod`.**')
                 embed.set_author(name=guild, icon_url=guild.icon_url)
@@ -60,5 +69,9 @@ class Automod(commands.Cog):
                 await self.bot.cogs['Moderation']._log(member, guild, msg, 'mute', reason)
                 await self.bot.cogs['Logging'].on_member_mute(guild.me, member, reason)
 
+            return True
+
+        return False
+
 def setup(bot):
     bot.add_cog(Automod(bot))
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import random
 
@@ -7,11 +8,16 @@ from discord.ext import commands
 from discord.ext.commands import command, guild_only
 
 import utils
+from cooldowns import Cooldowns
 
 class Economy(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # Daily credits outlive restarts.
+        self._daily = Cooldowns(1, 86400.0, name='credits')
+        bot.loop.create_task(self._daily.load(bot.pool))
+
     @command(name='balance', aliases=['acc', 'bal'], usage='balance [member]')
     async def balance(self, ctx, *, member: discord.Member = None):
         '''Display user account balance.
@@ -43,32 +49,37 @@ class Economy(commands.Cog):
         if not qty:
             return await ctx.send('Invalid *qty*.')
 
-        await self.bot.users_.update(ctx.author.id, 'tickets', bal-qty)
-
-        bal = self.bot.users_[member.id]['tickets']
-        await self.bot.users_.update(member.id, 'tickets', bal+qty)
+        if not await self.bot.users_.transfer(ctx.author.id, member.id, 'tickets', qty):
+            return await ctx.send('Invalid *qty*.')
 
         embed = Embed(color=utils.Color.sky)
         embed.set_author(name=f'Gave {qty} credits to {member.display_name}!', icon_url='attachment://unknown.png')
 
         await ctx.reply(file=File('assets/credits.png', 'unknown.png'), embed=embed, mention_author=False)
 
-    @commands.cooldown(1, 86400.0, type=commands.BucketType.user)
     @command(name='credits', aliases=['daily'], usage='tickets')
     async def credits(self, ctx):
         '''Collect your daily credits.
         Has a cooldown of 24 hours.\n
         **Example:```yml\n♤credits```**
         '''
-        bal = self.bot.users_[ctx.author.id]['tickets']
+        try:
+            await asyncio.wait_for(self._daily.loaded.wait(), 10)
+        except asyncio.TimeoutError:
+            return await ctx.send('Credits are not available yet, try again shortly.', delete_after=5)
+
+        if retry_after := self._daily.hit(ctx.author.id):
+            raise commands.CommandOnCooldown(commands.Cooldown(1, 86400.0, commands.BucketType.user), retry_after)
+        await self._daily.save(self.bot.pool, ctx.author.id)
+
         amt = 20
         if datetime.datetime.today().weekday() == 6:
             amt *= 2
 
-        await self.bot.users_.update(ctx.author.id, 'tickets', bal+amt)
+        bal = await self.bot.users_.increment(ctx.author.id, 'tickets', amt)
 
         embed = Embed(color=utils.Color.sky)
-        embed.set_author(name=f'Collected {amt} credits for a new balance of {bal+amt}!', icon_url='attachment://unknown.png')
+        embed.set_author(name=f'Collected {amt} credits for a new balance of {bal}!', icon_url='attachment://unknown.png')
         
         await ctx.reply(file=File('assets/credits.png', 'unknown.png'), embed=embed, mention_author=False)
 
@@ -5,7 +5,6 @@ from discord import Embed, File, AllowedMentions
 from discord.ext import commands
 from discord.ext.commands import command
 from discord.utils import escape_markdown
-import requests
 
 import utils
 
@@ -39,10 +38,9 @@ class Fun(commands.Cog):
 
         await ctx.reply(embed=embed, mention_author=False)
 
-    def _img(self, ctx, path: str, name: str = None) -> Embed:
+    async def _img(self, ctx, path: str, name: str = None) -> Embed:
         name = name if name else path.title()
-        res = requests.get(f'https://some-random-api.ml/img/{path}')
-        url = res.json()['link']
+        url = (await self.bot.web.json(f'https://some-random-api.ml/img/{path}'))['link']
 
         embed = Embed(description=f'{utils.Emoji.link} **[{name}]({url})**', color=random.choice(utils.Color.rainbow))
         embed.set_image(url=url)
@@ -54,49 +52,49 @@ class Fun(commands.Cog):
         '''Get a random bird.\n
         **Example:```yml\n♤bird```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'birb', 'Bird'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'birb', 'Bird'), mention_author=False)
 
     @command(name='cat', usage='cat')
     async def cat(self, ctx):
         '''Get a random cat.\n
         **Example:```yml\n♤cat```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'cat'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'cat'), mention_author=False)
 
     @command(name='dog', usage='dog')
     async def dog(self, ctx):
         '''Get a random dog.\n
         **Example:```yml\n♤dog```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'dog'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'dog'), mention_author=False)
 
     @command(name='fox', usage='fox')
     async def fox(self, ctx):
         '''Get a random fox.\n
         **Example:```yml\n♤fox```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'fox'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'fox'), mention_author=False)
 
     @command(name='koala', usage='koala')
     async def koala(self, ctx):
         '''Get a random koala.\n
         **Example:```yml\n♤koala```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'koala'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'koala'), mention_author=False)
 
     @command(name='panda', usage='panda')
     async def panda(self, ctx):
         '''Get a random panda.\n
         **Example:```yml\n♤panda```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'panda'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'panda'), mention_author=False)
 
     @command(name='redpanda', usage='redpanda')
     async def red_panda(self, ctx):
         '''Get a random red panda.\n
         **Example:```yml\n♤redpanda```**
         '''
-        await ctx.reply(embed=self._img(ctx, 'red_panda', 'Red panda'), mention_author=False)
+        await ctx.reply(embed=await self._img(ctx, 'red_panda', 'Red panda'), mention_author=False)
 
     @command(name='ping', aliases=['p'], usage='ping')
     async def ping(self, ctx):
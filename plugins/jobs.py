@@ -0,0 +1,256 @@
+import asyncio
+import time
+
+import discord
+from discord import Embed, File
+from discord.ext import commands
+from discord.ext.commands import command, guild_only
+
+import ccp
+import utils
+from utils import level
+
+# Seconds between progress saves and message edits
+_PROGRESS_INTERVAL = 5.0
+
+# A request slower than this waited on a rate limit
+_RATE_LIMITED = 1.0
+
+_MAX_WORKERS = 8
+
+class Job(object):
+    '''A bulk role job and its progress.
+
+    Members are processed in order of ID. `position` is the lowest ID that
+    may not be done yet, so a resumed job carries on from there.
+    '''
+    def __init__(self, record):
+        self.id = record['job_id']
+        self.guild_id = record['guild_id']
+        self.channel_id = record['channel_id']
+        self.message_id = record['message_id']
+        self.kind = record['kind']
+        self.role_id = record['role_id']
+        self.position = record['position']
+        self.done = record['done']
+        self.total = record['total']
+        self.status = record['status']
+
+        self.workers = 2.0
+        self.cancelled = False
+        self.message = None
+
+    @property
+    def percent(self) -> int:
+        return self.done * 100 // self.total if self.total else 100
+
+class Jobs(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self._jobs = {}
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch('SELECT * FROM role_jobs WHERE status = \'running\'')
+
+        for record in records:
+            if record['job_id'] not in self._jobs:
+                ccp.event(f'Resuming role job {record["job_id"]}', event='JOB_RESUME')
+                self._start(Job(record))
+
+    def _start(self, job: Job):
+        self._jobs[job.id] = job
+        self.bot.loop.create_task(self._run(job))
+
+    async def start(self, ctx, kind: str, role: discord.Role = None):
+        '''Starts a bulk role job in the guild of `ctx`.
+        `kind` is 'add' to add `role` to every member, or 'ranks' to apply rank roles.
+        '''
+        if any(job.guild_id == ctx.guild.id for job in self._jobs.values()):
+            embed = Embed(description='**A role job is already running in this server.**', color=utils.Color.red)
+            embed.set_author(name='Roles', icon_url='attachment://unknown.png')
+            return await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
+
+        embed = Embed(color=utils.Color.sky)
+        embed.set_author(name='Roles', icon_url='attachment://unknown.png')
+        embed.description = self._describe(kind, role.id if role else None, 0, 0)
+        msg = await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
+
+        async with self.bot.pool.acquire() as con:
+            query = ('INSERT INTO role_jobs (guild_id, channel_id, message_id, kind, role_id) '
+                     'VALUES ($1, $2, $3, $4, $5) RETURNING *')
+            record = await con.fetchrow(query, ctx.guild.id, ctx.channel.id, msg.id, kind, role.id if role else None)
+
+        self._start(Job(record))
+
+    def _describe(self, kind: str, role_id: int, done: int, total: int, status: str = 'running') -> str:
+        if kind == 'add':
+            desc = f'**Adding <@&{role_id}> to members...'
+        else:
+            desc = '**Rank roles successfully initialized.\n\nApplying roles to members...'
+
+        percent = done * 100 // total if total else 0
+        if status == 'done':
+            desc += ' Complete!'
+            percent = 100
+        elif status != 'running':
+            desc += f' {status.capitalize()}.'
+
+        progress = '█' * (percent//5)
+        space = ' ' * (20-len(progress))
+        return desc + f'\n`[{progress}{space}] {percent}% ({done}/{total})`**'
+
+    async def _save(self, job: Job, msg: discord.Message):
+        async with self.bot.pool.acquire() as con:
+            query = 'UPDATE role_jobs SET position = $1, done = $2, total = $3, status = $4 WHERE job_id = $5'
+            await con.execute(query, job.position, job.done, job.total, job.status, job.id)
+
+        if msg:
+            embed = msg.embeds[0]
+            embed.description = self._describe(job.kind, job.role_id, job.done, job.total, job.status)
+            try:
+                await msg.edit(embed=embed)
+            except discord.HTTPException:
+                pass
+
+    async def _apply(self, job: Job, member: discord.Member, role: discord.Role):
+        '''Updates the roles of one member, sending nothing if they are already right.'''
+        if job.kind == 'add':
+            if role not in member.roles:
+                await member.add_roles(role)
+        else:
+            record = await self.bot.members.fetch((member.id, member.guild.id), create=True)
+            await self.bot.cogs['Roles'].reconcile(member, level(record['xp']))
+
+    async def _work(self, job: Job, member: discord.Member, role: discord.Role):
+        start = time.perf_counter()
+        try:
+            await self._apply(job, member, role)
+        except discord.NotFound:
+            # The member left meanwhile.
+            pass
+        except discord.Forbidden:
+            job.status = 'failed'
+            return
+        except (discord.HTTPException, KeyError) as err:
+            # Skip the member rather than leave the error unretrieved.
+            ccp.error(f'Role job {job.id} failed on {member.id}: {err!r}')
+
+        # discord.py waits out rate limits itself, so a slow request
+        # means the bucket ran dry. Back off, otherwise ramp up slowly.
+        if time.perf_counter() - start > _RATE_LIMITED:
+            job.workers = max(1.0, job.workers / 2)
+        else:
+            job.workers = min(_MAX_WORKERS, job.workers + 1 / job.workers)
+
+    async def _run(self, job: Job):
+        try:
+            await self._process(job)
+        except Exception as err:
+            ccp.error(f'Role job {job.id} failed: {err!r}')
+            job.status = 'failed'
+        finally:
+            # A job left behind would block the guild from starting another.
+            self._jobs.pop(job.id, None)
+
+        try:
+            await self._save(job, job.message)
+        except Exception as err:
+            ccp.error(f'Failed to save role job {job.id}: {err!r}')
+
+    async def _process(self, job: Job):
+        '''Works through the members of a job.'''
+        guild = self.bot.get_guild(job.guild_id)
+        role = guild and job.role_id and guild.get_role(job.role_id)
+        if not guild or (job.kind == 'add' and not role):
+            job.status = 'failed'
+            return
+
+        try:
+            job.message = msg = await self.bot.get_channel(job.channel_id).fetch_message(job.message_id)
+        except (AttributeError, discord.HTTPException):
+            msg = None
+
+        if job.kind == 'ranks':
+            # Load the whole guild in one query rather than one per member
+            await self.bot.members.prefetch(guild_id=guild.id)
+
+        members = sorted((m for m in guild.members if not m.bot and m.id >= job.position), key=lambda m: m.id)
+        job.total = job.done + len(members)
+
+        running = {}
+        saved = time.monotonic()
+        for member in members:
+            while len(running) >= int(job.workers):
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    del running[task]
+                    job.done += 1
+
+            if job.cancelled or job.status != 'running':
+                break
+
+            # Every member below the oldest one still in progress is done.
+            job.position = min(running.values(), default=member.id)
+            if time.monotonic() - saved > _PROGRESS_INTERVAL:
+                saved = time.monotonic()
+                await self._save(job, msg)
+
+            running[self.bot.loop.create_task(self._work(job, member, role))] = member.id
+
+        if running:
+            await asyncio.wait(running)
+            job.done += len(running)
+
+        if job.cancelled:
+            job.status = 'cancelled'
+        elif job.status == 'running':
+            job.status = 'done'
+            job.position = members[-1].id + 1 if members else job.position
+
+    @command(name='jobs', usage='jobs')
+    @commands.has_guild_permissions(manage_roles=True)
+    @guild_only()
+    async def jobs(self, ctx):
+        '''Display the latest role jobs of the server.
+        Jobs are started by addall and setranks.\n
+        **Example:```yml\n♤jobs```**
+        '''
+        async with self.bot.pool.acquire() as con:
+            query = 'SELECT * FROM role_jobs WHERE guild_id = $1 ORDER BY job_id DESC LIMIT 5'
+            records = await con.fetch(query, ctx.guild.id)
+
+        embed = Embed(color=utils.Color.sky)
+        embed.set_author(name='Role jobs', icon_url='attachment://unknown.png')
+        if not records:
+            embed.description = '**No role jobs yet.**'
+        for record in records:
+            # Running jobs are ahead of what was last saved.
+            job = self._jobs.get(record['job_id']) or Job(record)
+            name = f'Add {ctx.guild.get_role(job.role_id) or "deleted role"}' if job.kind == 'add' else 'Rank roles'
+            value = f'**```yml\nID: {job.id}\nStatus: {job.status}\nProgress: {job.percent}% ({job.done}/{job.total})```**'
+            embed.add_field(name=name, value=value, inline=False)
+
+        await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
+
+    @command(name='canceljob', usage='canceljob <id>')
+    @commands.has_guild_permissions(manage_roles=True)
+    @guild_only()
+    async def canceljob(self, ctx, job_id: int):
+        '''Cancel a running role job.
+        Members done so far keep their roles.\n
+        **Example:```yml\n♤canceljob 12```**
+        '''
+        job = self._jobs.get(job_id)
+        if not job or job.guild_id != ctx.guild.id:
+            raise commands.BadArgument
+
+        job.cancelled = True
+
+        embed = Embed(description=f'**Cancelling role job {job_id}.**', color=utils.Color.sky)
+        embed.set_author(name='Role jobs', icon_url='attachment://unknown.png')
+        await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
+
+def setup(bot):
+    bot.add_cog(Jobs(bot))
@@ -13,19 +13,37 @@ from discord.utils import find
 import utils
 from utils import Emoji, findrole
 
+# Logs per page of a mod record
+_RECORD_PAGE = 20
+
+# Records longer than this are not counted exactly
+_RECORD_COUNT_CAP = 1000
+
+# Pages of a mod record kept while it is open
+_RECORD_CACHE = 5
+
+# Most messages one purge may delete, and look through to find them
+_PURGE_MAX = 1000
+_PURGE_SCAN = 5000
+
+# Messages older than this cannot be bulk deleted; a minute is left to spare
+_BULK_AGE = datetime.timedelta(days=14, minutes=-1)
+
+# Seconds between deletes of single messages
+_SINGLE_DELETE_DELAY = 1.0
+
 class Moderation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        bot.scheduler.register('mute', self._unmute)
 
     async def _log(self, user: Union[discord.Member, discord.User], guild: discord.Guild, msg: discord.Message, action: str, reason: str):
         async with self.bot.pool.acquire() as con:
-            sql = 'INSERT INTO modlog VALUES ($1, $2, $3, $4, $5, $6)'
+            sql = 'INSERT INTO modlog (user_id, guild_id, url, action, time, reason) VALUES ($1, $2, $3, $4, $5, $6)'
             await con.execute(sql, user.id, guild.id, msg.jump_url, action, datetime.datetime.utcnow(), reason)
 
-    async def _mute(self, user_id, guild_id, timeout: datetime):
-        now = datetime.datetime.utcnow()
-        Δ = (timeout-now).total_seconds()
-        await asyncio.sleep(Δ)
+    async def _unmute(self, key: str, payload: dict):
+        user_id, guild_id = map(int, key.split(':'))
 
         guild = self.bot.get_guild(guild_id)
         if guild:
@@ -34,19 +52,7 @@ class Moderation(commands.Cog):
             if member and mute_role:
                 await member.remove_roles(mute_role)
 
-        del self.bot.mute_tasks[user_id, guild_id]
-        self.bot.members[user_id, guild_id]['muted'] = None
-        async with self.bot.pool.acquire() as con:
-            stmt = 'UPDATE members SET muted = $1 WHERE user_id = $2 AND guild_id = $3'
-            await con.execute(stmt, None, user_id, guild_id)
-
-    @commands.Cog.listener()
-    @guild_only()
-    async def on_ready(self):
-        async with self.bot.pool.acquire() as con:
-            records = await con.fetch('SELECT user_id, guild_id, muted FROM members WHERE muted IS NOT NULL')
-            for user_id, guild_id, muted in records:
-                self.bot.mute_tasks[user_id, guild_id] = self.bot.loop.create_task(self._mute(user_id, guild_id, muted))
+        await self.bot.members.update((user_id, guild_id), 'muted', None)
 
     @command(name='ban', usage='ban <member> [reason]')
     @commands.has_guild_permissions(ban_members=True)
@@ -120,6 +126,53 @@ class Moderation(commands.Cog):
         await self._log(user, ctx.guild, msg, 'ban', reason if reason else '')
         await self.bot.cogs['Logging'].on_member_ban(ctx.author, user, reason)
 
+    async def _purge(self, chan: discord.TextChannel, before: discord.Message, n: int, members: tuple, progress=None) -> int:
+        '''Deletes up to `n` messages sent before `before`, only from `members` if any are given.
+        At most `_PURGE_SCAN` messages are looked at. Messages young enough are deleted
+        in bulk as they are found, and older ones one at a time once the scan ends.
+        `progress` is awaited with the number deleted so far after each batch.
+        Returns the number deleted.
+        '''
+        cutoff = datetime.datetime.utcnow() - _BULK_AGE
+        deleted = 0
+        batch = []
+        old = []
+        async for msg in chan.history(before=before, limit=_PURGE_SCAN):
+            if members and msg.author not in members:
+                continue
+
+            if msg.created_at > cutoff:
+                batch.append(msg)
+                if len(batch) == 100:
+                    await chan.delete_messages(batch)
+                    deleted += len(batch)
+                    batch = []
+                    if progress:
+                        await progress(deleted)
+            else:
+                old.append(msg)
+
+            if deleted + len(batch) + len(old) == n:
+                break
+
+        if batch:
+            await chan.delete_messages(batch)
+            deleted += len(batch)
+
+        # Bulk deletes refuse messages over 14 days old.
+        for i, msg in enumerate(old, 1):
+            try:
+                await msg.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+
+            if progress and i % 10 == 0:
+                await progress(deleted)
+            await asyncio.sleep(_SINGLE_DELETE_DELAY)
+
+        return deleted
+
     @command(name='delete', aliases=['del', 'purge'], usage='delete [quantity=1] [members]')
     @commands.has_permissions(manage_messages=True)
     @commands.bot_has_permissions(manage_messages=True)
@@ -127,30 +180,38 @@ class Moderation(commands.Cog):
     async def delete(self, ctx, n: int = 1, *members: discord.Member):
         '''Delete messages from a channel.
         Specify `quantity` to delete multiple messages. The command message will not be included in this amount.
-        `quantity` cannot be greater than 100 and messages that are more than 14 days old cannot be deleted.
+        `quantity` cannot be greater than 1000, and only the last 5000 messages are searched.
+        Messages that are more than 14 days old are deleted one at a time, which is slower.
         You can filter messages by member with `members`. Multiple members may be mentioned.\n
         **Example:```yml\n♤delete 5\n♤del 8 @Tau#4272```**
         '''
-        if not 0 < n <= 100:
+        if not 0 < n <= _PURGE_MAX:
             raise commands.BadArgument
 
-        messages = []
-        async for msg in ctx.channel.history(before=ctx.message, limit=None):
-            if msg.author in members or not members:
-                messages.append(msg)
-                if len(messages) == n:
-                    break
+        embed = Embed(color=utils.Color.red)
 
-        await ctx.channel.delete_messages(messages)
+        # Long purges report how far along they are.
+        msg = None
+        async def progress(deleted):
+            embed.set_author(name=f'Deleting messages... ({deleted}/{n})', icon_url='attachment://unknown.png')
+            await msg.edit(embed=embed)
 
-        content = f'Deleted {n} message'
-        if n != 1:
+        if n > 100:
+            embed.set_author(name=f'Deleting messages... (0/{n})', icon_url='attachment://unknown.png')
+            msg = await ctx.reply(file=File('assets/trashcan.png', 'unknown.png'), embed=embed, mention_author=False)
+
+        deleted = await self._purge(ctx.channel, ctx.message, n, members, progress if msg else None)
+
+        content = f'Deleted {deleted} message'
+        if deleted != 1:
             content += 's'
 
-        embed = Embed(color=utils.Color.red)
         embed.set_author(name=content, icon_url='attachment://unknown.png')
 
-        await ctx.reply(file=File('assets/trashcan.png', 'unknown.png'), embed=embed, mention_author=False)
+        if msg:
+            await msg.edit(embed=embed)
+        else:
+            await ctx.reply(file=File('assets/trashcan.png', 'unknown.png'), embed=embed, mention_author=False)
 
     @command(name='kick', usage='kick <member> [reason]')
     @commands.has_guild_permissions(kick_members=True)
@@ -254,9 +315,8 @@ class Moderation(commands.Cog):
         if perms.kick_members or perms.ban_members:
             return await ctx.send(f'{ctx.author.mention} Mods and admins cannot be muted.', delete_after=5)
 
-        if not self.bot.members.get((member.id, ctx.guild.id)):
-            await self.bot.members.insert((member.id, ctx.guild.id))
-        elif self.bot.members[member.id, ctx.guild.id]['muted']:
+        record = await self.bot.members.fetch((member.id, ctx.guild.id), create=True)
+        if record['muted']:
             return await ctx.send(f'**{member.display_name}** has already been muted.', delete_after=5)
 
         try:
@@ -271,7 +331,7 @@ class Moderation(commands.Cog):
                 raise commands.BadArgument
 
             timeout = now + delta
-            self.bot.mute_tasks[member.id, ctx.guild.id] = self.bot.loop.create_task(self._mute(member.id, ctx.guild.id, timeout))
+            await self.bot.scheduler.schedule('mute', f'{member.id}:{ctx.guild.id}', timeout)
         else:
             timeout = now
             if reason:
@@ -280,7 +340,7 @@ class Moderation(commands.Cog):
                 reason = limit
 
         await member.add_roles(mute_role, reason=reason)
-        await self.bot.members.update((member.id, ctx.guild.id), 'muted', str(timeout))
+        await self.bot.members.update((member.id, ctx.guild.id), 'muted', timeout)
 
         embed = Embed(description=f'**{Emoji.mute} You have been muted by `{ctx.author}`.**')
         embed.set_author(name=ctx.guild, icon_url=ctx.guild.icon_url)
@@ -309,6 +369,30 @@ class Moderation(commands.Cog):
         await self._log(member, ctx.guild, msg, 'mute', reason if reason else '')
         await self.bot.cogs['Logging'].on_member_mute(ctx.author, member, reason)
 
+    async def _record_page(self, user_id: int, guild_id: int, before: tuple = None, after: tuple = None,
+                           oldest: bool = False, limit: int = _RECORD_PAGE) -> list:
+        '''Returns up to `limit` logs of a user, newest first.
+        Only logs older than the `before` key or newer than the `after` key are
+        returned, or the oldest logs if `oldest` is set. Keys are (time, ctid).
+        '''
+        query = 'SELECT ctid, action, time FROM modlog WHERE user_id = $1 AND guild_id = $2'
+        args = [user_id, guild_id]
+        if before:
+            query += ' AND (time, ctid) < ($3, $4) ORDER BY time DESC, ctid DESC'
+            args += before
+        elif after:
+            query += ' AND (time, ctid) > ($3, $4) ORDER BY time, ctid'
+            args += after
+        elif oldest:
+            query += ' ORDER BY time, ctid'
+        else:
+            query += ' ORDER BY time DESC, ctid DESC'
+
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(f'{query} LIMIT {limit}', *args)
+
+        return records[::-1] if after or oldest else records
+
     @command(name='record', aliases=['history'], usage='record <member> [index]')
     @commands.has_guild_permissions(manage_roles=True)
     @commands.bot_has_permissions(add_reactions=True, manage_messages=True, external_emojis=True)
@@ -318,24 +402,31 @@ class Moderation(commands.Cog):
         Use `index` to view details on a log.\n
         **Example:```yml\n♤record @Tau#4272```**
         '''
+        # Counting stops at the cap, so a long record costs no more than a short one.
         async with self.bot.pool.acquire() as con:
-            query = 'SELECT url, action, time, reason FROM modlog WHERE user_id = $1 AND guild_id = $2 ORDER BY time DESC'
-            records = await con.fetch(query, member.id, ctx.guild.id)
+            query = 'SELECT count(*) FROM (SELECT 1 FROM modlog WHERE user_id = $1 AND guild_id = $2 LIMIT $3) AS logs'
+            total = await con.fetchval(query, member.id, ctx.guild.id, _RECORD_COUNT_CAP + 1)
+        capped = total > _RECORD_COUNT_CAP
+        count = f'{_RECORD_COUNT_CAP}+' if capped else total
 
-        plural = 's' if len(records) != 1 else ''
-        embed = Embed(title=f'Mod record: {len(records)} result{plural}')
+        plural = 's' if total != 1 else ''
+        embed = Embed(title=f'Mod record: {count} result{plural}')
         embed.set_author(name=member, icon_url=member.avatar_url)
 
-        if not records:
+        if not total:
             embed.description = '**This user does not have a mod record.**'
             return await ctx.send(embed=embed)
 
         if i != None:
-            try:
-                url, action, time_, reason = records[i-1].values()
-            except IndexError:
+            async with self.bot.pool.acquire() as con:
+                query = ('SELECT url, action, time, reason FROM modlog WHERE user_id = $1 AND guild_id = $2 '
+                         'ORDER BY time DESC, ctid DESC OFFSET $3 LIMIT 1')
+                record = await con.fetchrow(query, member.id, ctx.guild.id, i-1) if i > 0 else None
+
+            if not record:
                 return await ctx.send(f'{ctx.author.mention} Record with index `{i}` does not exist.`', delete_after=5)
 
+            url, action, time_, reason = record.values()
             embed.title = f'Record #{i}'
             embed.add_field(name='Action', value=action)
             if url:
@@ -345,32 +436,51 @@ class Moderation(commands.Cog):
 
             return await ctx.send(embed=embed)
 
-        i = 1
-        pages = []
-        logs = []
-        for record in records:
-            _, action, time_, _ = record.values()
-            align = ' ' if i < 10 else ''
-            space = ' ' * (7-len(action))
-            log = f'**`{i}.{align} {action+space} | {time_.date()}`**'
-            if len(logs) == 20:
-                pages.append('\n'.join(logs))
-                logs.clear()
-
-            logs.append(log)
-            i += 1
-
-        if logs:
-            pages.append('\n'.join(logs))
+        # Pages are read as they are turned to, from the keys of the pages
+        # next to them. Only the last few pages shown are kept.
+        pages = {}
+        bounds = {}
+        last = None if capped else -(-total // _RECORD_PAGE)
+
+        async def load(page: int) -> str:
+            if (desc := pages.pop(page, None)) is None:
+                if page == 1:
+                    records = await self._record_page(member.id, ctx.guild.id)
+                elif page-1 in bounds:
+                    records = await self._record_page(member.id, ctx.guild.id, before=bounds[page-1][1])
+                elif page+1 in bounds:
+                    records = await self._record_page(member.id, ctx.guild.id, after=bounds[page+1][0])
+                else:
+                    limit = total - (page-1)*_RECORD_PAGE
+                    records = await self._record_page(member.id, ctx.guild.id, oldest=True, limit=limit)
+
+                if not records:
+                    return None
+
+                bounds[page] = ((records[0]['time'], records[0]['ctid']), (records[-1]['time'], records[-1]['ctid']))
+                logs = []
+                for n, record in enumerate(records, (page-1)*_RECORD_PAGE + 1):
+                    align = ' ' if n < 10 else ''
+                    space = ' ' * (7-len(record['action']))
+                    logs.append(f'**`{n}.{align} {record["action"]+space} | {record["time"].date()}`**')
+                desc = '\n'.join(logs)
+
+            pages[page] = desc
+            if len(pages) > _RECORD_CACHE:
+                del pages[next(iter(pages))]
+            return desc
+
+        def footer(page: int) -> str:
+            return f'Page {page}/{last or f"{-(-_RECORD_COUNT_CAP // _RECORD_PAGE)}+"}'
 
         page = 1
-        embed.description = pages[0]
-        embed.set_footer(text=f'Page {page}/{len(pages)}')
+        embed.description = await load(page)
+        embed.set_footer(text=footer(page))
 
         msg = await ctx.send(embed=embed)
 
-        if len(pages) > 1:
-            emojis = (utils.emoji['start'], utils.emoji['previous'], utils.emoji['next'], utils.emoji['end'], utils.emoji['stop'])
+        if last != 1:
+            emojis = (Emoji.start, Emoji.previous, Emoji.next, Emoji.end, Emoji.stop)
             for emoji in emojis:
                 await msg.add_reaction(emoji)
 
@@ -387,27 +497,33 @@ class Moderation(commands.Cog):
                         if page == 1:
                             continue
 
-                        page = 1
+                        new = 1
                     elif emoji == emojis[1]: # previous
                         if page == 1:
                             continue
 
-                        page -= 1
+                        new = page - 1
                     elif emoji == emojis[2]: # next
-                        if page == len(pages):
+                        if page == last:
                             continue
 
-                        page += 1
+                        new = page + 1
                     elif emoji == emojis[3]: # end
-                        if page == len(pages):
+                        # The end of a capped record is not known.
+                        if page == last or not last:
                             continue
 
-                        page = len(pages)
+                        new = last
                     elif emoji == emojis[4]: # stop
                         raise asyncio.TimeoutError
 
-                    embed.description = pages[page-1]
-                    embed.set_footer(text=f'Page {page}/{len(pages)}')
+                    if (desc := await load(new)) is None:
+                        last = page
+                        continue
+
+                    page = new
+                    embed.description = desc
+                    embed.set_footer(text=footer(page))
 
                     await msg.edit(embed=embed)
                 except asyncio.TimeoutError:
@@ -496,22 +612,16 @@ class Moderation(commands.Cog):
         if member == ctx.author or member.bot:
             return
 
-        if not self.bot.members.get((member.id, ctx.guild.id)):
-            await self.bot.members.insert((member.id, ctx.guild.id))
-        elif not self.bot.members[member.id, ctx.guild.id]['muted']:
+        record = await self.bot.members.fetch((member.id, ctx.guild.id), create=True)
+        if not record['muted']:
             return await ctx.send(f'**{member.display_name}** has not been muted.', delete_after=5)
 
         mute_role = findrole(self.bot.guilds_[ctx.guild.id]['mute_role'], ctx.guild)
         await member.remove_roles(mute_role)
 
-        if task := self.bot.mute_tasks.get((member.id, ctx.guild.id)):
-            task.cancel()
-            del self.bot.mute_tasks[member.id, ctx.guild.id]
+        await self.bot.scheduler.cancel('mute', f'{member.id}:{ctx.guild.id}')
 
-        self.bot.members[member.id, ctx.guild.id]['muted'] = None
-        async with self.bot.pool.acquire() as con:
-            query = 'UPDATE members SET muted = $1 WHERE user_id = $2 AND guild_id = $3'
-            await con.execute(query, None, member.id, ctx.guild.id)
+        await self.bot.members.update((member.id, ctx.guild.id), 'muted', None)
 
         embed = Embed(description=f'**{Emoji.sound} You have been unmuted by `{ctx.author}`.**')
         embed.set_author(name=ctx.guild, icon_url=ctx.guild.icon_url)
@@ -50,8 +50,8 @@ class OnCommand(commands.Cog):
                 return await ctx.reply(content if content else None, embed=embed, mention_author=False)
             else:
                 async with self.bot.pool.acquire() as con:
-                    query = f'SELECT * FROM tags WHERE name LIKE \'%{name}%\' ORDER BY name DESC'
-                    tags = await con.fetch(query)
+                    query = 'SELECT name FROM tags WHERE guild_id = $1 AND name LIKE $2 ORDER BY name DESC'
+                    tags = await con.fetch(query, ctx.guild.id, f'%{name}%')
                 
                 if not tags:
                     return
@@ -147,6 +147,12 @@ class OnCommand(commands.Cog):
 
             return await ctx.reply(file=File('assets/reddot.png', 'unknown.png'), embed=embed)
 
+        if isinstance(error, utils.RendererBusy):
+            embed = Embed(description='**Too many images are being drawn right now. Please try again in a moment.**', color=utils.Color.red)
+            embed.set_author(name='Too busy!', icon_url='attachment://unknown.png')
+
+            return await ctx.reply(file=File('assets/reddot.png', 'unknown.png'), embed=embed)
+
         if isinstance(error, commands.CheckFailure):
             return
 
@@ -1,6 +1,7 @@
 import asyncio
 import io
 import random
+from bisect import bisect_right
 from typing import Tuple
 
 import discord
@@ -9,7 +10,9 @@ from discord.ext import commands
 from discord.ext.commands import command, guild_only, dm_only
 from discord.utils import find
 
+import pipeline
 import utils
+from cooldowns import Cooldowns
 from utils import level
 
 class Ranks(commands.Converter):
@@ -30,67 +33,76 @@ class RoleEntries(commands.RoleConverter):
 class Roles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self._cd = commands.CooldownMapping.from_cooldown(10, 120.0, commands.BucketType.user)
+        self._cd = Cooldowns(10, 120.0)
+        bot.pipeline.register('xp', self.award, pipeline.XP)
 
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        member = msg.author
+    def cog_unload(self):
+        self.bot.pipeline.unregister('xp')
+
+    async def award(self, ctx: pipeline.Context):
+        '''Gives XP for a message, at most 10 times every 2 minutes per member.'''
+        member = ctx.author
         uid = member.id
-        guild = msg.guild
-        chan = msg.channel
+        guild = ctx.guild
+        chan = ctx.channel
 
-        if member.bot or not guild:
+        if member.bot or not guild or ctx.is_command or ctx.suppressed:
             return
 
-        if not self.bot.members.get((uid, guild.id)):
-            await self.bot.members.insert((uid, guild.id))
-
-        prefix = self.bot.guilds_[guild.id]['prefix']
-        if not msg.content.startswith(prefix) and (member not in self.bot.suppressed.keys() or self.bot.suppressed.get(member) != chan):
-            bucket = self._cd.get_bucket(msg)
-            limited = bucket.update_rate_limit()
-            if not limited:
-                # Add xp to user
-                xp = self.bot.members[uid, guild.id]['xp']
-                newxp = xp + random.randint(5, 15)
-                await self.bot.members.update((uid, guild.id), 'xp', newxp)
-                
-                # Rank roles
-                if self.bot.ranks.get(guild.id) and (role_ids := self.bot.ranks[guild.id]['role_ids']):
-                    levels = self.bot.ranks[guild.id]['levels']
-                    roles = [guild.get_role(id) for id in role_ids]
-                    if None in roles:
-                        await self.bot.ranks.update(guild.id, 'role_ids', [])
-                        await self.bot.ranks.update(guild.id, 'levels', [])
-                        return
-
-                    rank = None
-                    for i in range(len(roles)-1, -1, -1):
-                        if level(newxp) >= levels[i]:
-                            rank = roles.pop(i)
-                            break
-                    
-                    for role in roles:
-                        if role in member.roles:
-                            await member.remove_roles(role)
-
-                    if rank:
-                        await member.add_roles(rank)
-
-                    # Send level up message if enabled in guild config.
-                    if level(xp) is not level(newxp) and self.bot.guilds_[guild.id]['levelup_messages']:
-                        if level(newxp) in levels:
-                            desc = f'**{member.display_name} has ranked up to {rank.mention}!**'
-                            embed = Embed(description=desc, color=rank.color)
-                            embed.set_author(name=member.display_name, icon_url=member.avatar_url)
-
-                            await chan.send(embed=embed)
-                        else:
-                            desc = f'**```yml\n↑ {level(newxp)} ↑ {member.display_name} has leveled up!```**'
-                            embed = Embed(description=desc, color=utils.Color.green)
-                            embed.set_author(name=member.display_name, icon_url=member.avatar_url)
-
-                            await chan.send(embed=embed)
+        if not self._cd.hit(uid):
+            # Add xp to user
+            gain = random.randint(5, 15)
+            newxp = await self.bot.members.increment((uid, guild.id), 'xp', gain)
+            lvl, newlvl = level(newxp - gain), level(newxp)
+
+            # Rank roles
+            if self.bot.ranks.get(guild.id) and (role_ids := self.bot.ranks[guild.id]['role_ids']):
+                thresholds = self.bot.ranks[guild.id]['levels']
+                roles = [guild.get_role(id) for id in role_ids]
+                if None in roles:
+                    await self.bot.ranks.upsert(guild.id, role_ids=[], levels=[])
+                    return
+
+                # Roles only change when a rank threshold is crossed.
+                if bisect_right(thresholds, lvl) != bisect_right(thresholds, newlvl):
+                    rank = await self.reconcile(member, newlvl)
+
+                # Send level up message if enabled in guild config.
+                if lvl != newlvl and self.bot.guilds_[guild.id]['levelup_messages']:
+                    if newlvl in thresholds:
+                        desc = f'**{member.display_name} has ranked up to {rank.mention}!**'
+                        embed = Embed(description=desc, color=rank.color)
+                        embed.set_author(name=member.display_name, icon_url=member.avatar_url)
+
+                        await chan.send(embed=embed)
+                    else:
+                        desc = f'**```yml\n↑ {newlvl} ↑ {member.display_name} has leveled up!```**'
+                        embed = Embed(description=desc, color=utils.Color.green)
+                        embed.set_author(name=member.display_name, icon_url=member.avatar_url)
+
+                        await chan.send(embed=embed)
+
+    async def reconcile(self, member, lvl):
+        '''Gives a member the rank role for their level and takes away any other rank role.
+        Nothing is sent if the roles are already right, otherwise the roles are set in one request.
+        Returns the rank role, if any.
+        '''
+        ranks = self.bot.ranks[member.guild.id]
+
+        # Levels are sorted, so the rank is the last one reached.
+        i = bisect_right(ranks['levels'], lvl) - 1
+        rank = member.guild.get_role(ranks['role_ids'][i]) if i >= 0 else None
+
+        # The first role is @everyone, which is never set explicitly.
+        current = member.roles[1:]
+        target = [role for role in current if role.id not in ranks['role_ids']]
+        if rank:
+            target.append(rank)
+
+        if set(target) != set(current):
+            await member.edit(roles=target)
+
+        return rank
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
@@ -152,32 +164,8 @@ class Roles(commands.Cog):
         '''
         if role == ctx.guild.default_role or ctx.guild.me.top_role <= role:
             raise commands.BadArgument
-        
-        members = list(filter(lambda m: not m.bot, ctx.guild.members))
-
-        desc = f'**Adding {role.mention} to members...'
-        embed = Embed(color=utils.Color.sky)
-        embed.set_author(name='Roles', icon_url='attachment://unknown.png')
-        embed.description = desc + f'\n`[                    ] 0% (0/{len(members)})`**'
-
-        i = 0
-        msg = await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
-        for member in members:
-            await member.add_roles(role)
-
-            i += 1
-            if i % 5 == 0:
-                percent = i // len(members) * 100
-                bar = '█'
-                progress = bar * (percent//5)
-                space = ' ' * (20-len(progress))
-                embed.description = desc + f'`[{progress}{space}] {percent}% ({i}/{len(members)})`**'
-                
-                await msg.edit(embed=embed)
-        else:
-            embed.description = desc + f' Complete!\n`[{bar*20}] 100% ({i}/{len(members)})`**'
 
-            await msg.edit(embed=embed)
+        await self.bot.cogs['Jobs'].start(ctx, 'add', role)
 
     @command(name='rolemenu', aliases=['rmenu'], usage='rolemenu <title> <color> <*roles>')
     @commands.has_guild_permissions(manage_guild=True)
@@ -212,8 +200,7 @@ class Roles(commands.Cog):
             await menu.delete()
             raise commands.BadArgument
 
-        await self.bot.rmenus.update((ctx.guild.id, menu.id), 'role_ids', [role.id for role in roles])
-        await self.bot.rmenus.update((ctx.guild.id, menu.id), 'emojis', list(emojis))
+        await self.bot.rmenus.upsert((ctx.guild.id, menu.id), role_ids=[role.id for role in roles], emojis=list(emojis))
 
     @command(name='rmlimit', usage='rmlimit <menu> <limit>')
     @commands.has_guild_permissions(manage_guild=True)
@@ -277,8 +264,7 @@ class Roles(commands.Cog):
             await menu.delete()
             raise commands.BadArgument
 
-        await self.bot.rmenus.update((ctx.guild.id, menu.id), 'role_ids', [role.id for role in roles])
-        await self.bot.rmenus.update((ctx.guild.id, menu.id), 'emojis', list(emojis))
+        await self.bot.rmenus.upsert((ctx.guild.id, menu.id), role_ids=[role.id for role in roles], emojis=list(emojis))
     
     @command(name='setranks', usage='setranks <*ranks>')
     @commands.has_guild_permissions(manage_guild=True)
@@ -319,42 +305,8 @@ class Roles(commands.Cog):
 
                 return await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
 
-        await self.bot.ranks.update(ctx.guild.id, 'levels', levels)
-        await self.bot.ranks.update(ctx.guild.id, 'role_ids', [rank.id for rank in ranks])
-
-        members = list(filter(lambda m: not m.bot, ctx.guild.members))
-
-        desc += 'initialized.\n\nApplying roles to members...'
-        embed.description = desc + f'\n`[                    ] 0% (0/{len(members)})`**'
-
-        i = 0
-        msg = await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
-        for member in members:
-            key = member.id, ctx.guild.id
-            if not self.bot.members.get(key):
-                await self.bot.members.insert(key)
-            
-            member_lvl = level(self.bot.members[key]['xp'])
-            levels.reverse()
-            ranks.reverse()
-            for level_, rank in zip(levels, ranks):
-                if level_ <= member_lvl:
-                    await member.add_roles(rank)
-                    break
-            
-            i += 1
-            if i % 5 == 0:
-                percent = i // len(members) * 100
-                bar = '█'
-                progress = bar * (percent//5)
-                space = 20 - len(progress)
-                embed.description = desc + f'`[{progress}{space}] {percent}% ({i}/{len(members)})`**'
-                
-                await msg.edit(embed=embed)
-        else:
-            embed.description = desc + f' Complete!\n`[{bar*20}] 100% ({i}/{len(members)})`**'
-
-            await msg.edit(embed=embed)
+        await self.bot.ranks.upsert(ctx.guild.id, levels=levels, role_ids=[rank.id for rank in ranks])
+        await self.bot.cogs['Jobs'].start(ctx, 'ranks')
 
     @command(name='ranks', usage='ranks')
     @commands.has_guild_permissions(manage_guild=True)
@@ -1,58 +1,58 @@
+import asyncio
 import datetime
 import io
-import json
 import random
 
+import aiohttp
 import discord
 from discord import Embed, File
 from discord.ext import commands
 from discord.ext.commands import command, guild_only
 from discord.utils import escape_markdown
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import requests
 import pprint
 
 import ccp
 import config
+import pipeline
+import render
 import utils
-from utils import Emoji, level, levelxp
+from cooldowns import Cooldowns
+from utils import Emoji, level
 
 class Social(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self._cd = commands.CooldownMapping.from_cooldown(1, 86400.0, commands.BucketType.user)
-
-    def get_gif(self, query: str) -> str:
-        query = query.replace(' ', '%20')
-        filters = 'contentfilter=medium&mediafilter=minimal&limit=1'
-        res = requests.get(f'https://api.tenor.com/v1/random?q={query}&key={config.tenor_api_key}&{filters}')
-        if res.status_code == 200:
-            obj = json.loads(res.content)
-            url = obj['results'][0]['media'][0]['gif']['url']
-            return url
-        
-        return ccp.error('Failed to reach Tenor servers')
+        self._cd = Cooldowns(1, 86400.0)
+        bot.pipeline.register('birthday', self.wish, pipeline.BIRTHDAY)
+
+    def cog_unload(self):
+        self.bot.pipeline.unregister('birthday')
+
+    async def get_gif(self, query: str) -> str:
+        params = {'q': query, 'key': config.tenor_api_key, 'contentfilter': 'medium', 'mediafilter': 'minimal', 'limit': 1}
+        try:
+            obj = await self.bot.web.json('https://api.tenor.com/v1/random', params=params)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return ccp.error('Failed to reach Tenor servers')
+
+        url = obj['results'][0]['media'][0]['gif']['url']
+        return url
     
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        if msg.author.bot:
+    async def wish(self, ctx: pipeline.Context):
+        '''Wishes users happy birthday on their first message of the day.'''
+        if not ctx.user:
             return
-        
-        if not self.bot.users_.get(msg.author.id):
-            return await self.bot.users_.insert(msg.author.id)
 
         # birthday stuff
-        bday = self.bot.users_[msg.author.id]['birthday']
+        bday = ctx.user['birthday']
         today = datetime.date.today()
         if bday:
             if today.month == bday.month and today.day == bday.day:
-                bucket = self._cd.get_bucket(msg)
-                limited = bucket.update_rate_limit()
-                if not limited:
+                if not self._cd.hit(ctx.author.id):
                     embed = Embed(color=utils.Color.pinky)
-                    embed.set_author(name=f'Happy birthday, {msg.author.display_name}!', icon_url='attachment://unknown.png')
+                    embed.set_author(name=f'Happy birthday, {ctx.author.display_name}!', icon_url='attachment://unknown.png')
 
-                    await msg.reply(file=File('assets/cake.png', 'unknown.png'), embed=embed)
+                    await ctx.msg.reply(file=File('assets/cake.png', 'unknown.png'), embed=embed)
 
     @command(name='birthday', aliases=['bday'], usage='birthday <mm/dd/yyyy>')
     async def birthday(self, ctx, date: str):
@@ -79,7 +79,7 @@ class Social(commands.Cog):
         '''Boop someone!\n
         **Example:```yml\n♤boop @Tau#4272```**
         '''
-        gif = self.get_gif('anime boop nose')
+        gif = await self.get_gif('anime boop nose')
         if gif:
             recipient = 'themselves' if ctx.author == member else member.display_name
             embed = Embed(color=utils.Color.lilac)
@@ -94,7 +94,7 @@ class Social(commands.Cog):
         '''Hug someone!\n
         **Example:```yml\n♤hug @Tau#4272```**
         '''
-        gif = self.get_gif('anime hug cute')
+        gif = await self.get_gif('anime hug cute')
         if gif:
             recipient = 'themselves' if ctx.author == member else member.display_name
             embed = Embed(color=utils.Color.lilac)
@@ -109,7 +109,7 @@ class Social(commands.Cog):
         '''Kiss someone!\n
         **Example:```yml\n♤kiss @Tau#4272```**
         '''
-        gif = self.get_gif('anime kiss')
+        gif = await self.get_gif('anime kiss')
         if gif:
             recipient = 'themselves' if ctx.author == member else member.display_name
             embed = Embed(color=utils.Color.pinky)
@@ -124,7 +124,7 @@ class Social(commands.Cog):
         '''Headpat someone!\n
         **Example:```yml\n♤pat @Tau#4272```**
         '''
-        gif = self.get_gif('anime headpat')
+        gif = await self.get_gif('anime headpat')
         if gif:
             recipient = 'themselves' if ctx.author == member else member.display_name
             embed = Embed(color=utils.Color.lilac)
@@ -139,7 +139,7 @@ class Social(commands.Cog):
         '''Slap someone! (not too hard tho)\n
         **Example:```yml\n♤slap @Tau#4272```**
         '''
-        gif = self.get_gif('anime slap')
+        gif = await self.get_gif('anime slap')
         if gif:
             recipient = 'themselves' if ctx.author == member else member.display_name
             embed = Embed(color=utils.Color.red)
@@ -191,30 +191,27 @@ class Social(commands.Cog):
 
         await ctx.send(embed=embed)
 
-    @command(name='leaderboard', aliases=['lb'], usage='leaderboard')
+    @command(name='leaderboard', aliases=['lb'], usage='leaderboard [page]')
     @guild_only()
-    async def leaderboard(self, ctx):
-        '''Display leaderboard.\n
-        **Example:```yml\n♤lb```**
+    async def leaderboard(self, ctx, page: int = 1):
+        '''Display leaderboard.
+        Each page lists 10 members.\n
+        **Example:```yml\n♤lb\n♤lb 2```**
         '''
-        async with self.bot.pool.acquire() as con:
-            records = await con.fetch(f'SELECT user_id, xp FROM members WHERE guild_id = {ctx.guild.id} ORDER BY xp DESC')
-            highscores = []
-            for record in records:
-                user_id, xp = record.values()
-                member = ctx.guild.get_member(user_id)
-                if member:
-                    highscores.append((member, xp))
-                    if len(highscores) == 10:
-                        break
+        if page < 1:
+            raise commands.BadArgument
+
+        start = (page - 1) * 10
+        highscores = await self.bot.rankings.top(ctx.guild, start, 10)
 
         embed = Embed(color=utils.Color.sky)
         embed.set_author(name='Leaderboard', icon_url='attachment://unknown.png')
         inline = False
-        for i, score in enumerate(highscores):
+        lvls = utils.levels([xp for _, xp in highscores])
+        for i, (score, lvl) in enumerate(zip(highscores, lvls), start):
             member, xp = score
             name = escape_markdown(str(member))
-            embed.add_field(name=f'**{i+1}.** {name}', value=f'**```yml\nLevel: {level(xp)}\nXP: {xp}```**', inline=inline)
+            embed.add_field(name=f'**{i+1}.** {name}', value=f'**```yml\nLevel: {lvl}\nXP: {xp}```**', inline=inline)
             inline = True
 
         await ctx.send(file=File('assets/dot.png', 'unknown.png'), embed=embed)
@@ -240,97 +237,31 @@ class Social(commands.Cog):
 
         message = await ctx.send(Emoji.loading)
 
-        res = requests.get(str(member.avatar_url))
-        with Image.open('assets/profile.png') as template, \
-             Image.open('assets/border.png') as border, \
-             Image.open(io.BytesIO(res.content)) as avatar:
-            # Copy the template and initialize the draw object
-            im = template.copy()
-            draw = ImageDraw.Draw(im)
-
-            xp = self.bot.members[member.id, ctx.guild.id]['xp']
-            lvl = level(xp)
-            accent = self.bot.users_[member.id]['accent']
-            font = ImageFont.truetype('assets/font/Comfortaa-Bold.ttf', 200)
-            font2 = ImageFont.truetype('assets/font/Comfortaa-Bold.ttf', 250)
-            bigfont = ImageFont.truetype('assets/font/Comfortaa-Bold.ttf', 500)
-
-            # Circular mask for avatar
-            size = (512, 512)
-            mask = Image.new('L', size, 0)
-            draw_mask = ImageDraw.Draw(mask)
-            draw_mask.ellipse((0, 0) + size, fill=255)
-            avatar = ImageOps.fit(avatar, mask.size, centering=(0.5, 0.5))
-            
-            # Avatar
-            w, h = avatar.size
-            im.paste(avatar, (594-w//2, 378-h//2), mask)
-
-            # Level
-            w, h = bigfont.getsize(str(lvl))
-            xo, yo = font.getoffset(str(lvl))
-            draw.text((594-w/2-xo/2, 930-h/2-yo/2), str(lvl), font=bigfont, fill=accent)
-
-            # Fetch the rank of the member
-            async with self.bot.pool.acquire() as con:
-                async with con.transaction():
-                    rank = 1
-                    async for record in con.cursor('SELECT user_id FROM members ORDER BY xp DESC'):
-                        if record['user_id'] == member.id:
-                            break
-                        rank += 1
-
-            # To iterate over the different texts, I decided to use a
-            # list of 2-tuples where the first index is the value of
-            # the midpoint of the corresponding image on the y-axis
-            # and the other is the integer value.
-            text = [
-                (252, rank), # Global rank
-                (624, xp), # XP
-                (978, self.bot.users_[member.id]['tickets']) # Tickets
-            ]
-            for y, val in text:
-                # Python has this neat trick to automatically interpolate
-                # commas into integers if they're long enough.
-                msg = f'{val:,}'
-
-                # The text becomes taller, since the commas dip below the rest
-                # of the letters. boost is to keep the text aligned with the
-                # image. This will break if the font size is changed, as it
-                # is a hard coded value.
-                boost = 0
-                if ',' in msg:
-                    boost = 22
-
-                _, h = font.getsize(msg)
-                _, offset = font.getoffset(msg)
-                draw.text((1600, y-h/2-offset/2+boost), msg, font=font, fill=accent)
-
-            # Progress bar
-            # Calculate the length of the progress bar as a
-            # percentage of the xp to next level
-            currentxp = xp - levelxp(lvl)
-            totalxp = levelxp(lvl + 1) - levelxp(lvl)
-            ratio = currentxp / totalxp
-            pos = 2500 * ratio + 129
-            draw.rectangle([129, 1264, pos, 1666], fill=accent)
-
-            # Progress bar text
-            msg = f'{currentxp}/{totalxp}'
-            x, _ = im.size
-            w, h = font.getsize(msg)
-            _, offset = font.getoffset(msg)
-            draw.text((x/2-w/2, 1465-h/2-offset/2), msg, font=font2, fill=f'#ffffff')
-
-            # Finalize by pasting the progress bar border
-            # to prevent the corners of the rectangle
-            # from jutting out.
-            final = Image.alpha_composite(im, border)
-
-            buffer = io.BytesIO()
-            final.save(buffer, 'png')
-
-            buffer.seek(0)
+        record = await self.bot.members.fetch((member.id, ctx.guild.id), create=True)
+        user = await self.bot.users_.fetch(member.id, create=True)
+
+        xp = record['xp']
+        rank = await self.bot.rankings.rank(member, xp)
+
+        # Cards are keyed by everything drawn on them.
+        avatar = self.bot.avatars.key(member)
+        key = self.bot.cards.key('profile', avatar[1:], xp, rank, user['tickets'], user['accent'])
+        if (card := self.bot.cards.get(key)) is None:
+            try:
+                spec = {
+                    'xp': xp,
+                    'level': level(xp),
+                    'rank': rank,
+                    'tickets': user['tickets'],
+                    'accent': user['accent'],
+                    'avatar': await self.bot.avatars.get(member)
+                }
+                card = await self.bot.renderer.render(render.profile_card, spec)
+            except utils.RendererBusy:
+                await message.delete()
+                raise
+
+            self.bot.cards.put(key, card)
 
         # decorators
         dec = []
@@ -343,7 +274,7 @@ class Social(commands.Cog):
         dec = ' '.join(dec)
 
         desc = f'{Emoji.statuses[str(member.status)]} **{escape_markdown(member.display_name)} {dec}\n`{member}`**\n\n'
-        if bio := self.bot.users_[member.id]["bio"]:
+        if bio := user['bio']:
             desc += f'**```yml\n{bio}```**'
         
         embed = Embed(description=desc)
@@ -352,7 +283,7 @@ class Social(commands.Cog):
         embed.timestamp = member.created_at
 
         await message.delete()
-        await ctx.send(file=File(buffer, 'unknown.png'), embed=embed)
+        await ctx.send(file=File(io.BytesIO(card), 'unknown.png'), embed=embed)
 
 def setup(bot):
     bot.add_cog(Social(bot))
\ No newline at end of file
@@ -52,9 +52,9 @@ class Starboard(commands.Cog):
                 qty = self.bot.guilds_[guild.id]['star_quantity']
                 if stars < qty:
                     return
-                if self.bot.stars.get(msg.id):
+                if star := await self.bot.stars.fetch(msg.id):
                     try:
-                        starmsg = await starchan.fetch_message(self.bot.stars[msg.id]['star_id'])
+                        starmsg = await starchan.fetch_message(star['star_id'])
                         await starmsg.edit(content=f'{star_emoji(stars)} **{stars}**', embed=embed)
                     except discord.NotFound:
                         await self.bot.stars.delete(msg.id)
@@ -68,7 +68,7 @@ class Starboard(commands.Cog):
     async def on_raw_reaction_remove(self, payload):
         emoji = str(payload.emoji)
         guild = self.bot.get_guild(payload.guild_id)
-        if emoji == '⭐' and self.bot.stars.get(payload.message_id):
+        if emoji == '⭐' and (star := await self.bot.stars.fetch(payload.message_id)):
             starchan = guild.get_channel(self.bot.guilds_[guild.id]['starboard_channel'])
             chan = guild.get_channel(payload.channel_id)
             if chan and starchan:
@@ -104,7 +104,7 @@ class Starboard(commands.Cog):
 
             qty = self.bot.guilds_[guild.id]['star_quantity']
             try:
-                starmsg = await starchan.fetch_message(self.bot.stars[msg.id]['star_id'])
+                starmsg = await starchan.fetch_message(star['star_id'])
             except discord.NotFound:
                 return await self.bot.stars.delete(msg.id)
 
@@ -25,19 +25,18 @@ class System(commands.Cog):
     async def on_guild_join(self, guild):
         ccp.event(f'{guild} ({guild.owner})', event='GUILD_ADD')
 
-        await self.bot.guilds_.insert(guild.id)
-        if guild.system_channel:
-            await self.bot.guilds_.update(guild.id, 'system_channel', guild.system_channel.id)
+        fields = {'system_channel': guild.system_channel.id} if guild.system_channel else {}
+        await self.bot.guilds_.upsert(guild.id, **fields)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         ccp.event(f'{guild} ({guild.owner})', event='GUILD_REM')
 
-        async with self.bot.pool.acquire() as con:
-            await self.bot.guilds_.delete(guild.id)
-            await con.execute('DELETE FROM members WHERE guild_id = $1', guild.id)
-            await con.execute('DELETE FROM role_menus WHERE guild_id = $1', guild.id)
-            await con.execute('DELETE FROM ranks WHERE guild_id = $1', guild.id)
+        await self.bot.guilds_.delete(guild.id)
+        await self.bot.members.delete_where('guild_id', guild.id)
+        self.bot.rankings.forget(guild.id)
+        await self.bot.rmenus.delete_where('guild_id', guild.id)
+        await self.bot.ranks.delete(guild.id)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
@@ -60,8 +59,8 @@ class System(commands.Cog):
 
             await chan.send(member.mention, file=File('assets/join.png', 'unknown.png'), embed=embed)
 
-        if self.bot.members.get((member.id, guild.id)):
-            muted = self.bot.members[member.id, guild.id]['muted']
+        if record := await self.bot.members.fetch((member.id, guild.id)):
+            muted = record['muted']
             if muted and muted > datetime.datetime.utcnow():
                 mute_role = member.guild.get_role(self.bot.guilds_[guild.id]['mute_role'])
                 if mute_role:
@@ -115,8 +114,7 @@ class System(commands.Cog):
         if user.bot:
             return
 
-        if self.bot.members.get((user.id, guild.id)):
-            await self.bot.members.delete((user.id, guild.id))
+        await self.bot.members.delete((user.id, guild.id))
 
     @command(name='config', aliases=['conf'], usage='config')
     @commands.has_guild_permissions(administrator=True)
@@ -340,6 +338,44 @@ class System(commands.Cog):
 
         await ctx.reply(file=File(f'assets/{color_name}dot.png', 'unknown.png'), embed=embed, mention_author=False)
 
+    @command(name='pipeline', aliases=['stages'], usage='pipeline')
+    @commands.is_owner()
+    async def pipeline(self, ctx):
+        '''Display the time spent in each stage of the message pipeline.\n
+        **Example:```yml\n♤pipeline```**
+        '''
+        lines = []
+        for name, (calls, total, worst) in self.bot.pipeline.stats.items():
+            avg = total / calls * 1000000 if calls else 0
+            lines.append(f'{name}: {calls} calls, {avg:.0f}µs avg, {worst*1000:.1f}ms max')
+
+        embed = Embed(description='**```yml\n' + '\n'.join(lines) + '```**', color=utils.Color.sky)
+        embed.set_author(name='Message pipeline', icon_url='attachment://unknown.png')
+
+        await ctx.reply(file=File('assets/dot.png', 'unknown.png'), embed=embed, mention_author=False)
+
+    @command(name='renders', usage='renders')
+    @commands.is_owner()
+    async def renders(self, ctx):
+        '''Display how well rendered images are being cached.\n
+        **Example:```yml\n♤renders```**
+        '''
+        cards = self.bot.cards
+        lookups = cards.hits + cards.misses
+        rate = cards.hits * 100 / lookups if lookups else 0
+        lines = [
+            f'Cards: {len(cards)} ({cards.size/1000/1000:.1f} MB)',
+            f'Hits: {cards.hits} ({rate:.0f}%)',
+            f'Misses: {cards.misses}',
+            f'Avatars: {len(self.bot.avatars)}',
+            f'Rendering: {len(self.bot.renderer)}/{self.bot.renderer.backlog}'
+        ]
+
+        embed = Embed(description='**```yml\n' + '\n'.join(lines) + '```**', color=utils.Color.sky)
+        embed.set_author(name='Renders', icon_url='attachment://unknown.png')
+
+        await ctx.reply(file=File('assets/dot.png', 'unknown.png'), embed=embed, mention_author=False)
+
     @command(name='remove', aliases=['leave', 'rem'], usage='remove [id]')
     @commands.is_owner()
     async def remove(self, ctx, id: int):
@@ -386,8 +422,7 @@ class System(commands.Cog):
         em = json.dumps(msg.embeds[0].to_dict()) if msg.embeds else '{}'
 
         # save
-        await self.bot.tags.update((ctx.guild.id, name), 'embed', em)
-        await self.bot.tags.update((ctx.guild.id, name), 'content', msg.content)
+        await self.bot.tags.upsert((ctx.guild.id, name), embed=em, content=msg.content)
 
         file = File('assets/dot.png', 'unknown.png')
         embed = Embed(description=f'You can now reference this tag using **`{ctx.prefix}{name}`**', color=utils.Color.sky)
@@ -428,7 +463,12 @@ class System(commands.Cog):
 
         await ctx.reply(files=files, embed=embed, mention_author=False)
 
+        for cache in self.bot.caches:
+            await cache.close()
+
         await self.bot.pool.close()
+        await self.bot.web.close()
+        self.bot.renderer.close()
         await self.bot.close()
 
         os._exit(0)
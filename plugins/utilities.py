@@ -1,4 +1,3 @@
-import asyncio
 import time
 import datetime
 import random
@@ -14,47 +13,27 @@ import utils
 class Utilities(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        bot.scheduler.register('reminder', self._remind)
 
-    async def _remind(self, ctx, reminder, timeout):
-        now = datetime.datetime.utcnow()
-        Δ = (timeout-now).total_seconds()
-        await asyncio.sleep(Δ)
+    async def _remind(self, key: str, payload: dict):
+        chan = self.bot.get_channel(payload['channel_id'])
+        user = self.bot.get_user(payload['user_id'])
+        if not chan or not user:
+            return
 
         try:
-            msg = await ctx.channel.fetch_message(ctx.message.id)
+            msg = await chan.fetch_message(payload['message_id'])
             ref = msg.to_reference()
-        except:
+        except (KeyError, discord.HTTPException):
             ref = None
 
         files = [File('assets/dot.png', 'unknown.png'), File('assets/clock.png', 'unknown1.png')]
-        embed = Embed(description=f'>>> {reminder}', color=utils.Color.sky)
+        embed = Embed(description=f'>>> {payload["reminder"]}', color=utils.Color.sky)
         embed.set_author(name='Reminder', icon_url='attachment://unknown.png')
         embed.set_footer(text='Time\'s up!', icon_url='attachment://unknown1.png')
-        embed.timestamp = timeout
+        embed.timestamp = datetime.datetime.utcnow()
 
-        await ctx.channel.send(ctx.author.mention if not ref else None, files=files, embed=embed, reference=ref)
-
-        async with self.bot.pool.acquire() as con:
-            query = 'DELETE FROM reminders WHERE user_id = $1 AND channel_id = $2 AND time = $3 AND reminder = $4'
-            await con.execute(query, ctx.author.id, ctx.channel.id, timeout, reminder)
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        async with self.bot.pool.acquire() as con:
-            records = await con.fetch('SELECT * FROM reminders')
-            for user_id, channel_id, timeout, reminder in records:
-                chan = self.bot.get_channel(channel_id)
-                if chan:
-                    member = chan.guild.get_member(user_id)
-                    if member:
-                        class Object:
-                            author = member
-                            channel = chan
-                        
-                        self.bot.loop.create_task(self._remind(Object, reminder, timeout))
-                    else:
-                        query = 'DELETE FROM reminders WHERE user_id = $1 AND channel_id = $2 AND time = $3 AND reminder = $4'
-                        await con.execute(query, user_id, channel_id, timeout, reminder)
+        await chan.send(user.mention if not ref else None, files=files, embed=embed, reference=ref)
 
     @command(name='channel', aliases=['chan'], usage='channel <channel>')
     @commands.bot_has_permissions(external_emojis=True)
@@ -191,11 +170,7 @@ class Utilities(commands.Cog):
         if member.bot:
             return
 
-        key = member.id, ctx.guild.id
-        if not self.bot.members.get(key):
-            await self.bot.members.insert(key)
-        
-        await self.bot.members.update(key, 'xp', xp+self.bot.members[key]['xp'])
+        await self.bot.members.increment((member.id, ctx.guild.id), 'xp', xp)
         listeners = self.bot.cogs['Roles'].get_listeners()
         for name, coro in listeners:
             if name == 'Roles':
@@ -260,10 +235,8 @@ class Utilities(commands.Cog):
             raise commands.BadArgument
         
         timeout = now + delta
-        self.bot.loop.create_task(self._remind(ctx, reminder, timeout))
-        async with self.bot.pool.acquire() as con:
-            query = 'INSERT INTO reminders VALUES ($1, $2, $3, $4)'
-            await con.execute(query, ctx.author.id, ctx.channel.id, timeout, reminder)
+        payload = {'user_id': ctx.author.id, 'channel_id': ctx.channel.id, 'message_id': ctx.message.id, 'reminder': reminder}
+        await self.bot.scheduler.schedule('reminder', str(ctx.message.id), timeout, payload)
 
         files = [File('assets/dot.png', 'unknown.png'), File('assets/clock.png', 'unknown1.png')]
         embed = Embed(description=f'>>> {reminder}', color=utils.Color.sky)
@@ -310,9 +283,8 @@ class Utilities(commands.Cog):
                 self.bot.rmenus[ctx.guild.id, new.id] = rmenu
                 del self.bot.rmenus[msg.guild.id, msg.id]
 
-                stmt = (f'UPDATE role_menus SET guild_id = {ctx.guild.id}, message_id = {new.id} '
-                        f'WHERE guild_id = {msg.guild.id} AND message_id = {msg.id}')
-                await con.execute(stmt)
+                stmt = 'UPDATE role_menus SET guild_id = $1, message_id = $2 WHERE guild_id = $3 AND message_id = $4'
+                await con.execute(stmt, ctx.guild.id, new.id, msg.guild.id, msg.id)
 
         await msg.delete()
 
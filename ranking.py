@@ -0,0 +1,364 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+from bisect import bisect_left, insort
+
+import asyncpg
+import discord
+import numpy as np
+
+import utils
+from store import ColumnStore
+
+class Leaderboard(object):
+    '''The members of a guild with the most XP, in order.
+
+    At most `size` rows are kept, and they are always the top rows of the
+    guild. A row that is not kept is only added once it passes the last
+    one. `complete` is set while every row of the guild is kept.
+    '''
+    def __init__(self, rows: list, size: int):
+        self.size = size
+        self.complete = len(rows) < size
+        self._entries = sorted((-xp, user_id) for user_id, xp in rows)[:size]
+        self._xp = {user_id: -xp for xp, user_id in self._entries}
+
+    def __iter__(self):
+        return ((user_id, -xp) for xp, user_id in self._entries)
+
+    def update(self, user_id: int, xp: int):
+        old = self._xp.get(user_id)
+        self.remove(user_id)
+
+        # A kept row that gained XP still belongs in the top rows. One that
+        # lost XP is only kept if it stays ahead of the last row, since rows
+        # that are not kept may now be ahead of it.
+        entry = (-xp, user_id)
+        gained = old is not None and xp >= old
+        if gained or self.complete or (self._entries and entry < self._entries[-1]):
+            insort(self._entries, entry)
+            self._xp[user_id] = xp
+            if len(self._entries) > self.size:
+                _, dropped = self._entries.pop()
+                del self._xp[dropped]
+                self.complete = False
+
+    def remove(self, user_id: int):
+        if (xp := self._xp.pop(user_id, None)) is not None:
+            del self._entries[bisect_left(self._entries, (-xp, user_id))]
+
+class RankIndex(object):
+    '''Counts XP values to tell how many are higher than a given one.
+
+    Values are grouped by level. A Fenwick tree over the levels counts the
+    values in higher levels in O(log L), and within its own level a value is
+    only compared with the distinct values of that level.
+    '''
+    def __init__(self):
+        self._tree = [0]
+        self._levels = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _resize(self, n: int):
+        '''Rebuilds the tree to hold at least `n` levels.'''
+        size = 1
+        while size <= n:
+            size *= 2
+
+        self._levels += [{} for _ in range(size - 1 - len(self._levels))]
+        self._tree = [0] * size
+        for i in range(1, size):
+            self._tree[i] += sum(self._levels[i-1].values())
+            if (j := i + (i & -i)) < size:
+                self._tree[j] += self._tree[i]
+
+    def _count(self, lvl: int) -> int:
+        '''Returns how many values are in the first `lvl` levels.'''
+        total = 0
+        i = min(lvl, len(self._tree) - 1)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, xp: int, n: int = 1):
+        '''Adds `n` occurrences of a value, or removes them if `n` is negative.'''
+        lvl = utils.level(xp)
+        if lvl >= len(self._tree):
+            self._resize(lvl)
+
+        counts = self._levels[lvl-1]
+        if (count := counts.get(xp, 0) + n):
+            counts[xp] = count
+        else:
+            del counts[xp]
+        self._len += n
+
+        i = lvl
+        while i < len(self._tree):
+            self._tree[i] += n
+            i += i & -i
+
+    def higher(self, xp: int) -> int:
+        '''Returns how many values are higher than `xp`.'''
+        lvl = utils.level(xp)
+        higher = self._len - self._count(lvl)
+        if lvl <= len(self._levels):
+            higher += sum(count for val, count in self._levels[lvl-1].items() if val > xp)
+        return higher
+
+class Ranking(object):
+    '''The XP of a set of member rows, indexed to rank them.'''
+    def __init__(self, keys: int, size: int = 1024):
+        self._xp = ColumnStore(keys, {'xp': 'int64'}, size)
+        self._index = RankIndex()
+
+    def __len__(self):
+        return len(self._xp)
+
+    def keys(self):
+        return self._xp.keys()
+
+    def set(self, key: tuple, xp: int):
+        if (old := self._xp.get(key)) is not None:
+            self._index.add(old['xp'], -1)
+
+        self._xp[key] = {'xp': xp}
+        self._index.add(xp)
+
+    def remove(self, key: tuple):
+        if (old := self._xp.pop(key, None)) is not None:
+            self._index.add(old['xp'], -1)
+
+    def rank(self, xp: int) -> int:
+        '''Returns 1 plus the number of rows with more XP than `xp`.'''
+        return self._index.higher(xp) + 1
+
+# One row of a binary COPY of (user_id, guild_id, xp), all bigint
+_COPY_ROW = np.dtype([('fields', '>i2'), ('user_len', '>i4'), ('user_id', '>i8'), ('guild_len', '>i4'),
+                      ('guild_id', '>i8'), ('xp_len', '>i4'), ('xp', '>i8')])
+
+class GlobalRanking(object):
+    '''Ranks every member row, built in bulk from a copy of the table.
+
+    The rows as read are held in NumPy arrays: their XP sorted, to count
+    higher values by binary search, and their keys sorted by user to find
+    the XP a row was read with. Rows changed since then are kept in a
+    RankIndex of corrections that adds their current XP and takes away the
+    XP they were read with.
+    '''
+    def __init__(self, users: np.ndarray, guilds: np.ndarray, xps: np.ndarray):
+        order = np.argsort(users, kind='stable')
+        self._users = users[order]
+        self._guilds = guilds[order]
+        self._xps = xps[order]
+        self._sorted = np.sort(xps)
+        self._changed = {}
+        self._delta = RankIndex()
+
+    @classmethod
+    def from_copy(cls, data: bytes, changes: list = ()):
+        '''Builds the ranking from binary COPY output, then applies
+        `changes`, a list of (key, xp) pairs. Runs in an executor.
+        '''
+        # Skip the signature, flags and header extension, and the trailer.
+        start = 19 + int.from_bytes(data[15:19], 'big')
+        rows = np.frombuffer(data, _COPY_ROW, (len(data) - start - 2) // _COPY_ROW.itemsize, start)
+        ranking = cls(rows['user_id'].astype(np.int64), rows['guild_id'].astype(np.int64), rows['xp'].astype(np.int64))
+
+        for key, xp in changes:
+            ranking.set(key, xp)
+        return ranking
+
+    def _read(self, key: tuple) -> int:
+        '''Returns the XP a row was read with, or None.'''
+        user_id, guild_id = key
+        lo = np.searchsorted(self._users, user_id)
+        hi = np.searchsorted(self._users, user_id, 'right')
+        for i in range(lo, hi):
+            if self._guilds[i] == guild_id:
+                return int(self._xps[i])
+        return None
+
+    def _replace(self, key: tuple, xp: int):
+        old = self._changed[key] if key in self._changed else self._read(key)
+        if old == xp:
+            return
+        if old is not None:
+            self._delta.add(old, -1)
+
+        self._changed[key] = xp
+        if xp is not None:
+            self._delta.add(xp)
+
+    def set(self, key: tuple, xp: int):
+        self._replace(key, xp)
+
+    def remove(self, key: tuple):
+        self._replace(key, None)
+
+    def forget(self, guild_id: int):
+        '''Removes every row of a guild.'''
+        rows = np.flatnonzero(self._guilds == guild_id)
+        keys = set(zip(self._users[rows].tolist(), self._guilds[rows].tolist()))
+        keys.update(key for key in self._changed if key[1] == guild_id)
+        for key in keys:
+            self.remove(key)
+
+    def rank(self, xp: int) -> int:
+        '''Returns 1 plus the number of rows with more XP than `xp`.'''
+        higher = len(self._sorted) - int(np.searchsorted(self._sorted, xp, 'right'))
+        return higher + self._delta.higher(xp) + 1
+
+class Rankings(object):
+    '''Leaderboards and ranks of members, kept up to date as member XP changes.
+
+    A guild's leaderboard is read from the database the first time it is
+    asked for and follows the members cache from then on. It is read again,
+    twice as long, when too many of its members have left the guild.
+
+    Ranks are counted over every member row, or the rows of one guild, the
+    same way. The global ranking is read once in the background.
+    '''
+    def __init__(self, pool: asyncpg.pool.Pool, members, size: int = 100):
+        self.pool = pool
+        self.members = members
+        self.size = size
+        self._boards = {}
+        self._ranks = {}
+        self._global = None
+        self._changes = None
+
+        members.listen(self._on_change)
+
+    def _on_change(self, index: tuple, record: dict):
+        user_id, guild_id = index
+        if (board := self._boards.get(guild_id)) is not None:
+            if record is None:
+                board.remove(user_id)
+            else:
+                board.update(user_id, record['xp'])
+
+        if (ranking := self._ranks.get(guild_id)) is not None:
+            if record is None:
+                ranking.remove((user_id,))
+            else:
+                ranking.set((user_id,), record['xp'])
+
+        if self._changes is not None:
+            # Held until the global ranking being built can take them.
+            if record is None:
+                self._changes.append((GlobalRanking.remove, (index,)))
+            else:
+                self._changes.append((GlobalRanking.set, (index, record['xp'])))
+        elif self._global is not None and self._global.done() and not self._global.exception():
+            if record is None:
+                self._global.result().remove(index)
+            else:
+                self._global.result().set(index, record['xp'])
+
+    async def _cached(self, guild_id: int = None):
+        '''Yields the index and XP of every cached member record, or only
+        those of a guild. Cached records may be ahead of the database while
+        writes are pending, so rankings read from it are updated with these.
+        '''
+        if guild_id is None:
+            records = list(self.members.items())
+        else:
+            records = list(self.members.where('guild_id', guild_id).items())
+
+        for i, (index, record) in enumerate(records, 1):
+            yield index, record['xp']
+            if i % 10000 == 0:
+                await asyncio.sleep(0)
+
+    async def _load(self, guild_id: int, size: int) -> Leaderboard:
+        query = 'SELECT user_id, xp FROM members WHERE guild_id = $1 ORDER BY xp DESC LIMIT $2'
+        async with self.pool.acquire() as con:
+            rows = {record['user_id']: record['xp'] for record in await con.fetch(query, guild_id, size)}
+        complete = len(rows) < size
+
+        async for (user_id, _), xp in self._cached(guild_id):
+            rows[user_id] = xp
+
+        board = Leaderboard(rows.items(), size)
+        board.complete = complete and len(rows) < size
+        return board
+
+    async def top(self, guild: discord.Guild, start: int = 0, count: int = 10) -> list:
+        '''Returns up to `count` (member, xp) pairs from position `start`
+        of the guild's leaderboard, skipping members who left the guild.
+        '''
+        size = self.size
+        while True:
+            if (board := self._boards.get(guild.id)) is None:
+                board = self._boards[guild.id] = await self._load(guild.id, size)
+
+            scores = [(member, xp) for user_id, xp in board if (member := guild.get_member(user_id))]
+            if len(scores) >= start + count or board.complete:
+                return scores[start:start+count]
+
+            size = board.size * 2
+            self._boards.pop(guild.id, None)
+
+    async def _load_ranking(self, guild_id: int) -> Ranking:
+        query = 'SELECT user_id, xp FROM members WHERE guild_id = $1'
+        ranking = Ranking(1, 16)
+        async with self.pool.acquire() as con:
+            for record in await con.fetch(query, guild_id):
+                ranking.set((record['user_id'],), record['xp'])
+
+        async for (user_id, _), xp in self._cached(guild_id):
+            ranking.set((user_id,), xp)
+        return ranking
+
+    async def _load_global(self) -> GlobalRanking:
+        # The table is copied in binary and parsed in bulk off the event loop.
+        # Changes made meanwhile are replayed on the result.
+        chunks = []
+        async def write(chunk):
+            chunks.append(chunk)
+
+        self._changes = changes = []
+        try:
+            query = 'SELECT user_id, guild_id, coalesce(xp, 0) FROM members'
+            async with self.pool.acquire() as con:
+                await con.copy_from_query(query, output=write, format='binary')
+
+            cached = [item async for item in self._cached()]
+            loop = asyncio.get_event_loop()
+            ranking = await loop.run_in_executor(None, GlobalRanking.from_copy, b''.join(chunks), cached)
+        finally:
+            self._changes = None
+
+        for func, args in changes:
+            func(ranking, *args)
+        return ranking
+
+    async def rank(self, member: discord.Member, xp: int, local: bool = False) -> int:
+        '''Returns the rank of a member with `xp` among all member rows,
+        or only among the rows of the member's guild if `local` is set.
+        '''
+        if local:
+            if (ranking := self._ranks.get(member.guild.id)) is None:
+                ranking = self._ranks[member.guild.id] = await self._load_ranking(member.guild.id)
+        else:
+            # Every caller waits on the same read of the table.
+            if self._global is None or (self._global.done() and self._global.exception()):
+                self._global = asyncio.ensure_future(self._load_global())
+            ranking = await asyncio.shield(self._global)
+
+        return ranking.rank(xp)
+
+    def forget(self, guild_id: int):
+        '''Drops the leaderboard and ranks of a guild.'''
+        self._boards.pop(guild_id, None)
+        self._ranks.pop(guild_id, None)
+
+        if self._changes is not None:
+            self._changes.append((GlobalRanking.forget, (guild_id,)))
+        elif self._global is not None and self._global.done() and not self._global.exception():
+            self._global.result().forget(guild_id)
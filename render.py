@@ -0,0 +1,183 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageOps
+
+import resources
+import utils
+from utils import levelxp
+
+def prepare_avatar(data: bytes, size: int) -> bytes:
+    '''Fits an avatar image file to a `size` square, masks it to a circle
+    and returns it as PNG, ready to be pasted onto a card.
+    '''
+    with Image.open(io.BytesIO(data)) as avatar:
+        avatar = ImageOps.fit(avatar.convert('RGBA'), (size, size), centering=(0.5, 0.5))
+        avatar.putalpha(resources.mask((size, size)))
+
+    buffer = io.BytesIO()
+    # Stored in the avatar cache and decoded on every render, so favour speed.
+    avatar.save(buffer, 'png', compress_level=1)
+    return buffer.getvalue()
+
+def profile_card(spec: dict) -> bytes:
+    '''Draws a profile card and returns it as PNG.
+
+    `spec` holds the card's `xp`, `level`, `rank`, `tickets`, `accent`
+    color and the `avatar` from prepare_avatar as bytes. This runs in a worker
+    process, so it takes and returns plain data only.
+    '''
+    xp = spec['xp']
+    lvl = spec['level']
+    accent = spec['accent']
+
+    with Image.open(io.BytesIO(spec['avatar'])) as avatar:
+        # Copy the template and initialize the draw object
+        im = resources.image('assets/profile.png')
+        draw = ImageDraw.Draw(im)
+
+        font = resources.font(200)
+        font2 = resources.font(250)
+        bigfont = resources.font(500)
+
+        # Avatar, already masked to a circle
+        w, h = avatar.size
+        im.paste(avatar, (594-w//2, 378-h//2), avatar)
+
+        # Level
+        w, h = bigfont.getsize(str(lvl))
+        xo, yo = font.getoffset(str(lvl))
+        draw.text((594-w/2-xo/2, 930-h/2-yo/2), str(lvl), font=bigfont, fill=accent)
+
+        # To iterate over the different texts, I decided to use a
+        # list of 2-tuples where the first index is the value of
+        # the midpoint of the corresponding image on the y-axis
+        # and the other is the integer value.
+        text = [
+            (252, spec['rank']), # Global rank
+            (624, xp), # XP
+            (978, spec['tickets']) # Tickets
+        ]
+        for y, val in text:
+            # Python has this neat trick to automatically interpolate
+            # commas into integers if they're long enough.
+            msg = f'{val:,}'
+
+            # The text becomes taller, since the commas dip below the rest
+            # of the letters. boost is to keep the text aligned with the
+            # image. This will break if the font size is changed, as it
+            # is a hard coded value.
+            boost = 0
+            if ',' in msg:
+                boost = 22
+
+            _, h = font.getsize(msg)
+            _, offset = font.getoffset(msg)
+            draw.text((1600, y-h/2-offset/2+boost), msg, font=font, fill=accent)
+
+        # Progress bar
+        # Calculate the length of the progress bar as a
+        # percentage of the xp to next level
+        currentxp = xp - levelxp(lvl)
+        totalxp = levelxp(lvl + 1) - levelxp(lvl)
+        ratio = currentxp / totalxp
+        pos = 2500 * ratio + 129
+        draw.rectangle([129, 1264, pos, 1666], fill=accent)
+
+        # Progress bar text
+        msg = f'{currentxp}/{totalxp}'
+        x, _ = im.size
+        w, h = font.getsize(msg)
+        _, offset = font.getoffset(msg)
+        draw.text((x/2-w/2, 1465-h/2-offset/2), msg, font=font2, fill=f'#ffffff')
+
+        # Finalize by pasting the progress bar border
+        # to prevent the corners of the rectangle
+        # from jutting out.
+        final = Image.alpha_composite(im, resources.image('assets/border.png', copy=False))
+
+        buffer = io.BytesIO()
+        final.save(buffer, 'png')
+
+    return buffer.getvalue()
+
+class Renderer(object):
+    '''Draws images in a pool of worker processes, one per core by default.
+    Each worker has the assets loaded before it takes any work.
+
+    At most `backlog` renders may be running or waiting at once. Beyond that
+    `render` raises utils.RendererBusy straight away rather than queueing
+    work that would finish too late to be useful.
+    '''
+    def __init__(self, workers: int = None, backlog: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.backlog = backlog or self.workers * 4
+        # Workers start fresh rather than forking a process with live sockets
+        # and threads; the initializer loads the assets in each of them.
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=resources.preload)
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+    async def render(self, func, *args) -> bytes:
+        '''Runs `func` with `args` in a worker and returns its result.'''
+        if self._pending >= self.backlog:
+            raise utils.RendererBusy
+
+        self._pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._pool, func, *args)
+        finally:
+            self._pending -= 1
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+class CardCache(object):
+    '''Rendered images keyed by a hash of everything drawn on them.
+
+    A card whose inputs change gets a new key, so entries never need to be
+    invalidated; old ones fall out of the LRU once it holds more than
+    `max_bytes`. `hits` and `misses` count lookups.
+    '''
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(*inputs) -> str:
+        return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+    def get(self, key: str) -> bytes:
+        if (data := self._entries.get(key)) is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if (old := self._entries.pop(key, None)) is not None:
+            self.size -= len(old)
+
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, dropped = self._entries.popitem(last=False)
+            self.size -= len(dropped)
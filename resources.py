@@ -0,0 +1,42 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+from PIL import Image, ImageDraw, ImageFont
+
+FONT = 'assets/font/Comfortaa-Bold.ttf'
+
+# Decoded once per process and shared from then on
+_images = {}
+_fonts = {}
+_masks = {}
+
+def image(path: str, copy: bool = True) -> Image.Image:
+    '''Returns the decoded image at `path`.
+    The image is shared unless `copy` is set, so it must not be drawn on.
+    '''
+    if (im := _images.get(path)) is None:
+        with Image.open(path) as file:
+            im = _images[path] = file.copy()
+
+    return im.copy() if copy else im
+
+def font(size: int, path: str = FONT) -> ImageFont.FreeTypeFont:
+    if (f := _fonts.get((path, size))) is None:
+        f = _fonts[path, size] = ImageFont.truetype(path, size)
+    return f
+
+def mask(size: tuple) -> Image.Image:
+    '''Returns a shared circular mask filling `size`.'''
+    if (im := _masks.get(size)) is None:
+        im = _masks[size] = Image.new('L', size, 0)
+        ImageDraw.Draw(im).ellipse((0, 0) + size, fill=255)
+    return im
+
+def preload():
+    '''Loads everything the image commands use.
+    Worker processes forked afterwards start with it already loaded.
+    '''
+    image('assets/profile.png', copy=False)
+    image('assets/border.png', copy=False)
+    for size in (200, 250, 500):
+        font(size)
+    mask((512, 512))
@@ -0,0 +1,158 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+import datetime
+import heapq
+import json
+import traceback
+
+import asyncpg
+
+import ccp
+
+# Seconds to wait before reading the table again after a failure
+_RETRY = 30.0
+
+class Scheduler(object):
+    '''Runs timers stored in the timers table when they are due.
+
+    A timer is identified by its `kind` and `key`, and scheduling it again
+    replaces it. Every timer is written to the table before it is held in
+    memory, so none are lost on restart.
+
+    Only timers due before `_horizon` are held, in a min-heap. The table is
+    paged `window` seconds at a time by its indexed due_at column, and a
+    single loop callback is armed for whichever comes first, the next timer
+    or the end of the page.
+
+    A timer is claimed by deleting its row before its handler runs, so it
+    runs once however often the scheduler is started.
+    '''
+    def __init__(self, pool: asyncpg.pool.Pool, window: float = 300.0):
+        self.pool = pool
+        self.window = datetime.timedelta(seconds=window)
+        self._handlers = {}
+        self._heap = []
+        self._pending = {}
+        self._horizon = None
+        self._handle = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def register(self, kind: str, func):
+        '''Sets the coroutine run with the key and payload of due timers of `kind`.'''
+        self._handlers[kind] = func
+
+    async def start(self):
+        '''Loads the first page of timers. Does nothing if already started.'''
+        if self._horizon is None:
+            await self._load()
+            self._arm()
+
+    async def schedule(self, kind: str, key: str, due_at: datetime.datetime, payload: dict = None):
+        '''Stores a timer and arms it if it falls within the loaded page.'''
+        async with self.pool.acquire() as con:
+            query = ('INSERT INTO timers (kind, key, due_at, payload) VALUES ($1, $2, $3, $4) '
+                     'ON CONFLICT (kind, key) DO UPDATE SET due_at = EXCLUDED.due_at, payload = EXCLUDED.payload')
+            await con.execute(query, kind, key, due_at, json.dumps(payload))
+
+        if self._horizon is not None and due_at < self._horizon:
+            self._push(kind, key, due_at)
+            self._arm()
+        else:
+            self._pending.pop((kind, key), None)
+
+    async def cancel(self, kind: str, key: str) -> bool:
+        '''Deletes a timer. Returns True if it had not run yet.'''
+        self._pending.pop((kind, key), None)
+        async with self.pool.acquire() as con:
+            return await con.fetchval('DELETE FROM timers WHERE kind = $1 AND key = $2 RETURNING true', kind, key) or False
+
+    def _push(self, kind: str, key: str, due_at: datetime.datetime):
+        # Replaced timers stay in the heap and are skipped when popped.
+        self._pending[kind, key] = due_at
+        heapq.heappush(self._heap, (due_at, kind, key))
+
+    async def _load(self):
+        start = self._horizon
+        # Timers scheduled while the page is read are held from now on.
+        self._horizon = datetime.datetime.utcnow() + self.window
+        try:
+            async with self.pool.acquire() as con:
+                if start is None:
+                    query = 'SELECT kind, key, due_at FROM timers WHERE due_at < $1'
+                    records = await con.fetch(query, self._horizon)
+                else:
+                    query = 'SELECT kind, key, due_at FROM timers WHERE due_at >= $1 AND due_at < $2'
+                    records = await con.fetch(query, start, self._horizon)
+        except:
+            self._horizon = start
+            raise
+
+        for kind, key, due_at in records:
+            if (kind, key) not in self._pending:
+                self._push(kind, key, due_at)
+
+    def _arm(self, delay: float = 0.0):
+        if self._handle:
+            self._handle.cancel()
+
+        due_at = min(self._heap[0][0], self._horizon) if self._heap else self._horizon
+        delay = max(delay, (due_at - datetime.datetime.utcnow()).total_seconds())
+        self._handle = asyncio.get_event_loop().call_later(delay, lambda: asyncio.ensure_future(self._run()))
+
+    async def _run(self):
+        if self._running:
+            return
+
+        self._running = True
+        retry = 0.0
+        try:
+            now = datetime.datetime.utcnow()
+            while self._heap and self._heap[0][0] <= now:
+                due_at, kind, key = heapq.heappop(self._heap)
+                if self._pending.get((kind, key)) == due_at:
+                    del self._pending[kind, key]
+                    asyncio.ensure_future(self._fire(kind, key, due_at))
+
+            if now >= self._horizon:
+                await self._load()
+        except Exception as err:
+            # Dropped connections raise more than OSError; all are retried later.
+            ccp.error(f'Failed to load timers: {err!r}')
+            retry = _RETRY
+        finally:
+            self._running = False
+            self._arm(retry)
+
+    async def _fire(self, kind: str, key: str, due_at: datetime.datetime):
+        if (func := self._handlers.get(kind)) is None:
+            # Left in the table for when the handler is registered.
+            return ccp.error(f'No handler for {kind} timers')
+
+        try:
+            async with self.pool.acquire() as con:
+                query = 'DELETE FROM timers WHERE kind = $1 AND key = $2 AND due_at = $3 RETURNING payload'
+                record = await con.fetchrow(query, kind, key, due_at)
+        except Exception as err:
+            ccp.error(f'Failed to claim {kind} timer {key}: {err!r}')
+            # Held again unless it was rescheduled meanwhile, so it is not
+            # left in the table until the next start.
+            await asyncio.sleep(_RETRY)
+            if (kind, key) not in self._pending:
+                self._push(kind, key, due_at)
+                self._arm()
+            return
+
+        # Cancelled, rescheduled or claimed by an earlier start
+        if record is None:
+            return
+
+        try:
+            payload = record['payload']
+            await func(key, json.loads(payload) if payload is not None else None)
+        except Exception:
+            ccp.error(f'{kind} timer {key} failed')
+            traceback.print_exc()
@@ -0,0 +1,279 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Markers in the hash index of a ColumnStore
+_EMPTY = -1
+_DELETED = -2
+
+class Records(dict):
+    '''A dict of records that remembers when each one was last used.'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._atime = OrderedDict()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._atime.pop(key, None)
+
+    def pop(self, key, *default):
+        self._atime.pop(key, None)
+        return super().pop(key, *default)
+
+    def touch(self, key: any):
+        self._atime[key] = time.monotonic()
+        self._atime.move_to_end(key)
+
+    def evict(self, capacity: int, ttl: float = None, keep: dict = ()) -> list:
+        '''Drops least recently used records until there are at most `capacity`,
+        along with any record that has not been used within `ttl` seconds.
+        Records in `keep` are never dropped. Returns the dropped keys.
+        '''
+        now = time.monotonic()
+        kept = []
+        dropped = []
+        while self._atime:
+            key, atime = next(iter(self._atime.items()))
+            if len(self) <= capacity and (not ttl or now - atime < ttl):
+                break
+
+            del self._atime[key]
+            if key in keep:
+                kept.append((key, atime))
+            else:
+                super().pop(key, None)
+                dropped.append(key)
+
+        for key, atime in reversed(kept):
+            self._atime[key] = atime
+            self._atime.move_to_end(key, last=False)
+
+        return dropped
+
+class Row(object):
+    '''A record of a ColumnStore. Reads and writes go straight to the arrays.
+
+    A row is only valid while its record is stored. Once the record is
+    deleted or evicted, its slot may be handed to another record.
+    '''
+    __slots__ = ('_store', '_slot')
+
+    def __init__(self, store, slot: int):
+        self._store = store
+        self._slot = slot
+
+    def __getitem__(self, col: str):
+        return self._store._get(self._slot, col)
+
+    def __setitem__(self, col: str, val: any):
+        self._store._set(self._slot, col, val)
+
+    def __iter__(self):
+        return iter(self._store.columns)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, col: str, default: any = None):
+        return self[col] if col in self._store.columns else default
+
+    def keys(self):
+        return self._store.columns.keys()
+
+    def items(self):
+        return ((col, self[col]) for col in self._store.columns)
+
+    def update(self, other: dict):
+        for col, val in other.items():
+            self[col] = val
+
+    def copy(self) -> dict:
+        return dict(self.items())
+
+class ColumnStore(object):
+    '''A mapping of integer key tuples to records with fixed columns,
+    kept in parallel NumPy arrays instead of a dict per record.
+
+    Each record takes one slot in every array. Keys are found through an
+    open addressing hash index that maps the hash of a key to its slot.
+    Integer columns read back as ints and datetime columns as datetimes,
+    with None stored as NaT. Records are returned as `Row` views.
+    '''
+    def __init__(self, keys: int, columns: dict, size: int = 1024):
+        self.columns = {col: np.dtype(dtype) for col, dtype in columns.items()}
+        self._nkeys = keys
+        self._len = 0
+        self._top = 0
+        self._free = []
+        self._swept = time.monotonic()
+
+        self._keys = np.zeros((size, keys), np.int64)
+        self._cols = {col: self._empty(dtype, size) for col, dtype in self.columns.items()}
+        self._used = np.zeros(size, bool)
+        self._atime = np.zeros(size, np.float64)
+        self._build(size * 2)
+
+    @staticmethod
+    def _empty(dtype: np.dtype, size: int) -> np.ndarray:
+        return np.full(size, np.datetime64('NaT'), dtype) if dtype.kind == 'M' else np.zeros(size, dtype)
+
+    def _build(self, size: int):
+        '''Rebuilds the hash index with `size` buckets, which must be a power of two.'''
+        self._index = np.full(size, _EMPTY, np.int64)
+        self._deleted = 0
+        mask = size - 1
+        for slot in np.flatnonzero(self._used):
+            i = hash(tuple(self._keys[slot].tolist())) & mask
+            while self._index[i] != _EMPTY:
+                i = (i + 1) & mask
+            self._index[i] = slot
+
+    def _grow(self):
+        size = len(self._used)
+        self._keys = np.concatenate((self._keys, np.zeros((size, self._nkeys), np.int64)))
+        for col, dtype in self.columns.items():
+            self._cols[col] = np.concatenate((self._cols[col], self._empty(dtype, size)))
+        self._used = np.concatenate((self._used, np.zeros(size, bool)))
+        self._atime = np.concatenate((self._atime, np.zeros(size, np.float64)))
+
+    def _find(self, key: tuple) -> tuple:
+        '''Returns the slot of a key, or -1, and the bucket it is or would be in.'''
+        mask = len(self._index) - 1
+        i = hash(key) & mask
+        free = None
+        while True:
+            slot = int(self._index[i])
+            if slot == _EMPTY:
+                return -1, i if free is None else free
+            if slot == _DELETED:
+                if free is None:
+                    free = i
+            elif tuple(self._keys[slot].tolist()) == key:
+                return slot, i
+            i = (i + 1) & mask
+
+    def _get(self, slot: int, col: str):
+        val = self._cols[col][slot]
+        if self.columns[col].kind == 'M':
+            return None if np.isnat(val) else val.astype('datetime64[us]').item()
+        return val.item()
+
+    def _set(self, slot: int, col: str, val: any):
+        if val is None and self.columns[col].kind == 'M':
+            val = np.datetime64('NaT')
+        self._cols[col][slot] = val
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key: tuple):
+        return self._find(key)[0] >= 0
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, key: tuple) -> Row:
+        slot = self._find(key)[0]
+        if slot < 0:
+            raise KeyError(key)
+        return Row(self, slot)
+
+    def __setitem__(self, key: tuple, record: dict):
+        slot, i = self._find(key)
+        if slot < 0:
+            # Keep the index at most half full, counting deleted buckets.
+            if (self._len + self._deleted + 1) * 2 > len(self._index):
+                self._build(len(self._index) * (2 if self._len * 4 > len(self._index) else 1))
+                slot, i = self._find(key)
+
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if self._top == len(self._used):
+                    self._grow()
+                slot = self._top
+                self._top += 1
+
+            if self._index[i] == _DELETED:
+                self._deleted -= 1
+            self._index[i] = slot
+            self._keys[slot] = key
+            self._used[slot] = True
+            self._atime[slot] = time.monotonic()
+            self._len += 1
+        elif isinstance(record, Row) and record._store is self and record._slot == slot:
+            return
+
+        for col, val in record.items():
+            self._set(slot, col, val)
+
+    def __delitem__(self, key: tuple):
+        slot, i = self._find(key)
+        if slot < 0:
+            raise KeyError(key)
+
+        self._index[i] = _DELETED
+        self._deleted += 1
+        self._used[slot] = False
+        for col, dtype in self.columns.items():
+            self._cols[col][slot] = self._empty(dtype, 1)[0]
+        self._free.append(slot)
+        self._len -= 1
+
+    def get(self, key: tuple, default: any = None):
+        slot = self._find(key)[0]
+        return Row(self, slot) if slot >= 0 else default
+
+    def pop(self, key: tuple, *default):
+        '''Removes a record and returns its values as a dict.'''
+        slot = self._find(key)[0]
+        if slot < 0:
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        record = Row(self, slot).copy()
+        del self[key]
+        return record
+
+    def keys(self):
+        return (tuple(key) for key in self._keys[self._used].tolist())
+
+    def values(self):
+        return (Row(self, int(slot)) for slot in np.flatnonzero(self._used))
+
+    def items(self):
+        return ((tuple(self._keys[slot].tolist()), Row(self, int(slot))) for slot in np.flatnonzero(self._used))
+
+    def touch(self, key: tuple):
+        slot = self._find(key)[0]
+        if slot >= 0:
+            self._atime[slot] = time.monotonic()
+
+    def evict(self, capacity: int, ttl: float = None, keep: dict = ()) -> list:
+        '''Drops least recently used records once there are more than `capacity`,
+        along with any record that has not been used within `ttl` seconds.
+        Records in `keep` are never dropped. Returns the dropped keys.
+
+        Over capacity, an extra sixteenth of `capacity` is evicted at once so
+        that the arrays are scanned rarely. Expired records are swept at most
+        four times per TTL.
+        '''
+        now = time.monotonic()
+        if self._len > capacity:
+            slots = np.flatnonzero(self._used)
+            n = min(self._len - capacity + capacity // 16, len(slots))
+            victims = slots[np.argpartition(self._atime[slots], n - 1)[:n]]
+        elif ttl and now - self._swept > ttl / 4:
+            self._swept = now
+            victims = np.flatnonzero(self._used & (self._atime < now - ttl))
+        else:
+            return []
+
+        dropped = [key for key in map(tuple, self._keys[victims].tolist()) if key not in keep]
+        for key in dropped:
+            del self[key]
+        return dropped
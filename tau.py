@@ -3,18 +3,29 @@
 import asyncio
 import asyncpg
 import datetime
+import mmap
 import os
+import pickle
+import re
 import sys
-from collections.abc import Iterable
-
+import time
 import discord
 from discord import Game, Object, Permissions
 from discord.ext import commands
 from discord.utils import oauth_url
 
+import avatars
 import ccp
 import config
+import migrations
+import pipeline
+import ranking
+import render
+import resources
+import scheduler
 import utils
+import web
+from store import ColumnStore, Records
 
 if os.name == 'nt':
     os.system('color')
@@ -29,8 +40,8 @@ def prefix(bot, msg):
 
 bot = commands.Bot(command_prefix=prefix, help_command=None, intents=discord.Intents.all())
 
+bot.caches = []
 bot.invites_ = {}
-bot.mute_tasks = {}
 bot.suppressed = {}
 bot.start_time = datetime.datetime.utcnow()
 
@@ -46,6 +57,14 @@ for dir, _, files in os.walk('.'):
             with open(f'{dir}/{file}', encoding='utf8') as py:
                 bot.code += len(py.readlines())
 
+# Rows per round trip when streaming a table into the cache
+_PREFETCH = 5000
+
+_SNAPSHOTS = 'snapshots'
+_SNAPSHOT_MARGIN = datetime.timedelta(minutes=1)
+
+_CONSTRAINTS = {'PRIMARY', 'UNIQUE', 'CONSTRAINT', 'FOREIGN', 'CHECK', 'EXCLUDE'}
+
 class aobject(object):
     '''Inheriting this class allows async class constructors.'''
     async def __new__(cls, *args, **kwargs):
@@ -53,37 +72,330 @@ class aobject(object):
         await instance.__init__(*args, **kwargs)
         return instance
 
-class Cache(aobject):
-    async def __init__(self, table: str, pk: str, schema: str, default: dict):
-        async with bot.pool.acquire() as con:
-            await con.execute(f'CREATE TABLE IF NOT EXISTS {table} ({schema})')
-            records = await con.fetch(f'SELECT * FROM {table}')
+class _Unwritten(object):
+    '''The records of a write-behind cache with changes not yet in the database.'''
+    __slots__ = ('cache',)
 
-        cache = {}
-        for record in records:
-            pktup = tuple(pk.split(', '))
-            index = record[pk] if len(pk.split(', ')) == 1 else tuple(v for k, v in record.items() if k in pktup)
-            cache[index] = dict(record)
-            for key in pktup:
-                del cache[index][key]
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __contains__(self, index: any) -> bool:
+        return index in self.cache._dirty or index in self.cache._inflight
 
+class Cache(aobject):
+    '''In-memory mirror of a database table.
+
+    With `write_behind` enabled, updates and increments to existing records
+    are applied to the cache immediately and coalesced in memory. Dirty records are written
+    in one batch every `flush_interval` seconds, or sooner once `flush_size`
+    records are dirty. At most `max_batches` batches wait to be written.
+
+    With `lazy` enabled, nothing is loaded up front. Records are read from the
+    database on first access through `fetch` and at most `capacity` of them
+    are kept, evicting the least recently used. Records unused for `ttl`
+    seconds are evicted as well. Synchronous lookups only see cached records.
+
+    With `snapshot` enabled, the cache is saved to disk on close and every
+    `snapshot_interval` seconds. On startup the snapshot is loaded and only
+    rows written or deleted since it was taken are read from the database.
+    The table must have its changes tracked by a migration.
+
+    Records are kept in a dict unless `store` is given, which is called to
+    create the mapping instead, such as a `ColumnStore` for large tables.
+
+    Each primary key column named in `indexes` gets a secondary index from
+    its values to the cached keys, so that `where` and `delete_where` only
+    touch the records that match.
+
+    Functions registered with `listen` are told of every record written
+    through the cache, so that derived structures can follow along.
+    '''
+    async def __init__(self, table: str, pk: str, schema: str, default: dict,
+                       write_behind: bool = False, flush_interval: float = 5.0,
+                       flush_size: int = 500, max_batches: int = 4,
+                       lazy: bool = False, capacity: int = 100000, ttl: float = None,
+                       snapshot: bool = False, snapshot_interval: float = 900.0,
+                       store: callable = None, indexes: tuple = ()):
         self.table = table
         self.schema = schema
         self.pk = pk
-        self._records = cache
         self.default = default.copy()
 
+        # Column names are read from the schema once, skipping table constraints.
+        # Commas inside parentheses belong to a type or a constraint.
+        names = [col.split()[0] for col in re.split(r',\s*(?![^()]*\))', schema)]
+        self._pk = tuple(pk.split(', '))
+        self.columns = tuple(name for name in names if name.upper() not in _CONSTRAINTS and name not in self._pk)
+        self._compile()
+
+        # Key columns never change, so an indexed record only has
+        # to be linked when it is cached and unlinked when it is dropped.
+        if any(col not in self._pk for col in indexes):
+            raise KeyError(indexes)
+        self._indexes = {col: (self._pk.index(col), {}) for col in indexes}
+        self._listeners = []
+
+        async with bot.pool.acquire() as con:
+            start = time.perf_counter()
+            self._records = (store or (Records if lazy else dict))()
+            if not lazy and (snap := snapshot and self._read_snapshot()):
+                self._records, watermark = snap
+                await self._catch_up(con, watermark)
+            elif not lazy:
+                # Rows are streamed through a server-side cursor straight
+                # into the cache instead of being fetched into a list first.
+                async with con.transaction():
+                    async for record in con.cursor(self._select, prefetch=_PREFETCH):
+                        index, record = self._row(record)
+                        self._records[index] = record
+
+            for index in self._records.keys():
+                self._link(index)
+
+            self.load_time = time.perf_counter() - start
+
+        self.lazy = lazy
+        if lazy:
+            self.capacity = capacity
+            self.ttl = ttl
+
+        self._tasks = []
+        self.write_behind = write_behind
+        if write_behind:
+            self.flush_interval = flush_interval
+            self.flush_size = flush_size
+            self._dirty = {}
+            self._deltas = {}
+            # Records in batches that are queued or being written, and how many
+            self._inflight = {}
+            self._unwritten = _Unwritten(self)
+            self._full = asyncio.Event()
+            self._batches = asyncio.Queue(maxsize=max_batches)
+            self._tasks += bot.loop.create_task(self._flush_loop()), bot.loop.create_task(self._write_loop())
+
+        self.snapshot = snapshot and not lazy
+        if self.snapshot:
+            self.snapshot_interval = snapshot_interval
+            self._tasks.append(bot.loop.create_task(self._snapshot_loop()))
+
+        bot.caches.append(self)
+
+    def _compile(self):
+        '''Builds the parameterized statements used by this cache.
+
+        The text of each statement never changes, so asyncpg prepares it once
+        per connection and reuses the plan. Values are always sent as bind
+        parameters. UPDATE statements take the primary key last.
+        '''
+        n = len(self.columns)
+        cols = ', '.join(self._pk + self.columns)
+        params = ', '.join(f'${i+1}' for i in range(len(self._pk)+n))
+
+        self._select = f'SELECT {cols} FROM {self.table}'
+        self._select_one = f'{self._select} WHERE {self._condition(0)}'
+        self._insert = f'INSERT INTO {self.table} ({cols}) VALUES ({params})'
+        self._delete = f'DELETE FROM {self.table} WHERE {self._condition(0)}'
+        self._updates = {}
+        self._upserts = {}
+        self._increments = {}
+        for col in self.columns:
+            self._statement((col,))
+            self._upsert_statement((col,))
+
+    def _condition(self, offset: int) -> str:
+        return ' AND '.join(f'{k} = ${i+offset+1}' for i, k in enumerate(self._pk))
+
+    def _statement(self, keys: tuple, deltas: tuple = ()) -> str:
+        '''Returns the UPDATE statement for a set of columns, compiling it on first use.
+        Columns in `deltas` are added to instead of being overwritten.
+        '''
+        if (keys, deltas) not in self._updates:
+            if any(key not in self.columns for key in keys + deltas):
+                raise KeyError(keys + deltas)
+
+            cols = [f'{k} = ${i+1}' for i, k in enumerate(keys)]
+            cols += [f'{k} = {k} + ${i+len(keys)+1}' for i, k in enumerate(deltas)]
+            self._updates[keys, deltas] = f'UPDATE {self.table} SET {", ".join(cols)} WHERE {self._condition(len(cols))}'
+
+        return self._updates[keys, deltas]
+
+    def _increment_statement(self, key: str) -> str:
+        '''Returns the statement adding to a column, compiling it on first use.
+        A missing record is created with the increment applied to its default.
+        '''
+        if key not in self._increments:
+            if key not in self.columns:
+                raise KeyError(key)
+
+            n = len(self._pk) + len(self.columns)
+            self._increments[key] = (f'{self._insert} ON CONFLICT ({self.pk}) DO UPDATE SET {key} = {self.table}.{key} + ${n+1} '
+                                     f'RETURNING {", ".join(self._pk + self.columns)}')
+
+        return self._increments[key]
+
+    def _upsert_statement(self, keys: tuple) -> str:
+        '''Returns the upsert statement for a set of columns, compiling it on first use.
+
+        Every column is bound so that a missing record is created in full,
+        but only the given columns are overwritten on conflict.
+        '''
+        if keys not in self._upserts:
+            if any(key not in self.columns for key in keys):
+                raise KeyError(keys)
+
+            if keys:
+                action = 'UPDATE SET ' + ', '.join(f'{k} = EXCLUDED.{k}' for k in keys)
+            else:
+                action = 'NOTHING'
+
+            self._upserts[keys] = f'{self._insert} ON CONFLICT ({self.pk}) DO {action} RETURNING {", ".join(self._pk + self.columns)}'
+
+        return self._upserts[keys]
+
+    @property
+    def _snapshot_path(self) -> str:
+        return os.path.join(_SNAPSHOTS, f'{self.table}.snapshot')
+
+    def _read_snapshot(self):
+        '''Returns the records and watermark of the snapshot on disk,
+        or None if it is missing, unreadable or taken with another schema.
+        '''
+        try:
+            with open(self._snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                schema, watermark, records = pickle.loads(mm)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+
+        return (records, watermark) if schema == self.schema else None
+
+    def _write_snapshot(self, data: tuple):
+        os.makedirs(_SNAPSHOTS, exist_ok=True)
+        tmp = self._snapshot_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Replace the old snapshot atomically so a crash never leaves half a file.
+        os.replace(tmp, self._snapshot_path)
+
+    async def _catch_up(self, con: asyncpg.Connection, watermark: datetime.datetime):
+        '''Applies the rows deleted and written since the snapshot watermark.'''
+        # Transactions still open when the snapshot was taken may
+        # commit later with an earlier timestamp, hence the margin.
+        since = watermark - _SNAPSHOT_MARGIN
+
+        # Deletions go first so that a row deleted and then written again is kept.
+        pk = ', '.join(f'(r).{k}' for k in self._pk)
+        query = (f'SELECT {pk} FROM (SELECT jsonb_populate_record(NULL::{self.table}, old) AS r '
+                 'FROM tombstones WHERE tbl = $1 AND deleted_at > $2) t')
+        for row in await con.fetch(query, self.table, since):
+            self._records.pop(row[0] if len(self._pk) == 1 else tuple(row), None)
+
+        for record in await con.fetch(f'{self._select} WHERE updated_at > $1', since):
+            index, record = self._row(record)
+            self._records[index] = record
+
+    async def save(self):
+        '''Writes a snapshot of the cache to disk.'''
+        await self.flush()
+        async with bot.pool.acquire() as con:
+            watermark = await con.fetchval('SELECT now()::timestamp')
+
+        # Pickling runs in a thread on a shallow copy, so the cache stays usable meanwhile.
+        data = self.schema, watermark, dict(self._records)
+        await bot.loop.run_in_executor(None, self._write_snapshot, data)
+
+        async with bot.pool.acquire() as con:
+            await con.execute('DELETE FROM tombstones WHERE tbl = $1 AND deleted_at < $2', self.table, watermark - _SNAPSHOT_MARGIN)
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            # Any failure is retried on the next interval; the loop must not die.
+            try:
+                await self.save()
+            except Exception as err:
+                ccp.error(f'Failed to save a snapshot of {self.table}: {err!r}')
+
+    @staticmethod
+    def _key(index: any) -> tuple:
+        return index if isinstance(index, tuple) else (index,)
+
+    def _row(self, record: asyncpg.Record) -> tuple:
+        values = tuple(record)
+        n = len(self._pk)
+        index = values[0] if n == 1 else values[:n]
+        return index, dict(zip(self.columns, values[n:]))
+
+    def _link(self, index: any):
+        for pos, groups in self._indexes.values():
+            groups.setdefault(self._key(index)[pos], set()).add(index)
+
+    def _unlink(self, index: any):
+        for pos, groups in self._indexes.values():
+            val = self._key(index)[pos]
+            if (group := groups.get(val)) is not None:
+                group.discard(index)
+                if not group:
+                    del groups[val]
+
+    def listen(self, func: callable):
+        '''Calls `func(index, record)` whenever a record is read or written,
+        and `func(index, None)` when it is deleted. Evictions are not reported.
+        '''
+        self._listeners.append(func)
+
+    def _notify(self, index: any, record: dict):
+        for func in self._listeners:
+            func(index, record)
+
+    def _drop(self, index: any):
+        '''Removes a record from the cache only.'''
+        self._records.pop(index, None)
+        self._unlink(index)
+        if self.write_behind:
+            self._dirty.pop(index, None)
+            self._deltas.pop(index, None)
+        self._notify(index, None)
+
+    def _store(self, index: any, record: dict):
+        '''Stores a record and returns it as held by the cache.'''
+        self._records[index] = record
+        self._link(index)
+        if self.lazy:
+            self._records.touch(index)
+            # Records with writes not yet committed are kept, or reading
+            # them back could cache a value older than the one pending.
+            for dropped in self._records.evict(self.capacity, self.ttl, self._unwritten if self.write_behind else ()):
+                self._unlink(dropped)
+
+        record = self._records.get(index)
+        self._notify(index, record)
+        return record
+
     def __getitem__(self, key: any):
-        return self._records[key]
+        record = self._records[key]
+        if self.lazy:
+            self._records.touch(key)
+        return record
 
     def __setitem__(self, key, val):
         self._records[key] = val
+        self._link(key)
+        self._notify(key, val)
 
     def __delitem__(self, key):
         del self._records[key]
+        self._unlink(key)
+        self._notify(key, None)
 
     def get(self, key: any, default: any = None):
-        return self._records.get(key, default)
+        record = self._records.get(key)
+        if record is None:
+            return default
+
+        if self.lazy:
+            self._records.touch(key)
+        return record
 
     def keys(self):
         return self._records.keys()
@@ -91,61 +403,302 @@ class Cache(aobject):
     def values(self):
         return self._records.values()
 
+    def items(self):
+        return self._records.items()
+
+    async def fetch(self, index: any, create: bool = False):
+        '''Returns a record, reading it from the database if it is not cached.
+        If `create` is set, a missing record will be created.
+        '''
+        record = self.get(index)
+        if record is None and self.lazy:
+            async with bot.pool.acquire() as con:
+                row = await con.fetchrow(self._select_one, *self._key(index))
+
+            # Another fetch may have cached the record while this one waited,
+            # and its copy may already hold changes not yet written.
+            if (record := self._records.get(index)) is None and row:
+                record = self._store(index, self._row(row)[1])
+
+        if record is None and create:
+            await self.insert(index)
+            record = self._records.get(index)
+
+        return record
+
+    async def prefetch(self, **where):
+        '''Reads every record matching the given columns in one query.
+        Records that are already cached are kept as they are.
+        '''
+        cols = tuple(where)
+        if not cols or any(col not in self._pk + self.columns for col in cols):
+            raise KeyError(cols)
+
+        condition = ' AND '.join(f'{k} = ${i+1}' for i, k in enumerate(cols))
+        async with bot.pool.acquire() as con:
+            records = await con.fetch(f'{self._select} WHERE {condition}', *where.values())
+
+        for record in records:
+            index, record = self._row(record)
+            if index not in self._records:
+                self._store(index, record)
+
+    def where(self, col: str, val: any) -> dict:
+        '''Returns the cached records whose indexed column `col` equals `val`.'''
+        return {index: self._records[index] for index in self._indexes[col][1].get(val, ())}
+
     async def delete(self, index: any):
         '''Deletes a record in the database and the cache.'''
-        del self._records[index]
+        self._drop(index)
+
         async with bot.pool.acquire() as con:
-            if isinstance(index, Iterable):
-                condition = ' AND '.join(f'{k} = ${i+1}' for i, k in enumerate(self.pk.split(', ')))
-                await con.execute(f'DELETE FROM {self.table} WHERE {condition}', *index)
-            else:
-                await con.execute(f'DELETE FROM {self.table} WHERE {self.pk} = $1', index)
+            await con.execute(self._delete, *self._key(index))
 
-    async def insert(self, index: any):
-        '''Creates a new record in the database and the cache.'''
-        self._records[index] = self.default.copy()
+    async def delete_where(self, col: str, val: any):
+        '''Deletes every record whose indexed column `col` equals `val`
+        in the database and the cache, including records not cached.
+        '''
+        for index in list(self._indexes[col][1].get(val, ())):
+            self._drop(index)
 
-        index = (index,) if not isinstance(index, tuple) else index
-        val = index + tuple(self.default.values())
-        n = ', '.join(f'${i+1}' for i in range(len(self.default)+len(index)))
         async with bot.pool.acquire() as con:
-            await con.execute(f'INSERT INTO {self.table} VALUES ({n})', *tuple(val))
+            await con.execute(f'DELETE FROM {self.table} WHERE {col} = $1', val)
+
+    async def insert(self, index: any):
+        '''Creates a new record in the database and the cache.
+        An existing record is loaded instead of being overwritten.
+        '''
+        await self.upsert(index)
 
     async def update(self, index: any, key: any, val: any):
         '''Updates both the database and the cache. If the record does not exist, it will be created.'''
-        if not self._records.get(index):
-            await self.insert(index)
-
-        self._records[index][key] = val
-        if isinstance(val, str):
-            val = val.replace('\'', '\'\'')
-            val = f'\'{val}\''
-        elif isinstance(val, list):
-            schema = self.schema.split()
-            type = schema[schema.index(key)+1].replace(',', '')
-            val = f'ARRAY{val}' if val else f'ARRAY{val}::{type}'
-        elif isinstance(val, datetime.date):
-            val = f'\'{val}\''
+        if self.write_behind and self._records.get(index):
+            self._statement((key,))
+            self._records[index][key] = val
+            self._dirty.setdefault(index, set()).add(key)
+            self._deltas.get(index, {}).pop(key, None)
+            if len(self._dirty) >= self.flush_size:
+                self._full.set()
+            self._notify(index, self._records[index])
+            return
+
+        await self.upsert(index, **{key: val})
+
+    async def increment(self, index: any, key: any, delta: int) -> int:
+        '''Adds `delta` to a field in the database and returns the new value.
+        Concurrent increments never overwrite each other.
+        If the record does not exist, it will be created.
+        '''
+        if self.write_behind and (record := self._records.get(index)):
+            self._statement((), (key,))
+            record[key] += delta
+            # A pending overwrite already carries the new value.
+            if key not in self._dirty.setdefault(index, set()):
+                deltas = self._deltas.setdefault(index, {})
+                deltas[key] = deltas.get(key, 0) + delta
+            if len(self._dirty) >= self.flush_size:
+                self._full.set()
+            self._notify(index, record)
+            return record[key]
+
+        stmt = self._increment_statement(key)
+        record = dict(self.default, **{key: self.default[key] + delta})
+        async with bot.pool.acquire() as con:
+            row = await con.fetchrow(stmt, *self._key(index), *(record[col] for col in self.columns), delta)
+
+        return self._refresh(index, row)[key]
+
+    async def transfer(self, src: any, dst: any, key: any, amount: int) -> tuple:
+        '''Moves `amount` of a field from one record to another in a single transaction.
+        Returns the new values of both records, or None if `src` has less than `amount`.
+        If `dst` does not exist, it will be created.
+        '''
+        if self.write_behind and (src in self._unwritten or dst in self._unwritten):
+            await self.flush()
+            await self._batches.join()
+
+        cols = ', '.join(self._pk + self.columns)
+        withdraw = (f'UPDATE {self.table} SET {key} = {key} - $1 '
+                    f'WHERE {self._condition(1)} AND {key} >= $1 RETURNING {cols}')
+        stmt = self._increment_statement(key)
+        record = dict(self.default, **{key: self.default[key] + amount})
+        async with bot.pool.acquire() as con:
+            async with con.transaction():
+                if not (taken := await con.fetchrow(withdraw, amount, *self._key(src))):
+                    return None
+                given = await con.fetchrow(stmt, *self._key(dst), *(record[col] for col in self.columns), amount)
+
+        return self._refresh(src, taken)[key], self._refresh(dst, given)[key]
+
+    def _refresh(self, index: any, row: asyncpg.Record):
+        '''Replaces the cached values of a record with a row just written.'''
+        values = self._row(row)[1]
+        if (record := self._records.get(index)) is not None:
+            record.update(values)
+            self._notify(index, record)
+            return record
+        return self._store(index, values)
+
+    async def upsert(self, index: any, **fields):
+        '''Sets any number of fields on a record in a single statement.
+        If the record does not exist, it will be created with the remaining fields set to their defaults.
+        '''
+        stmt = self._upsert_statement(tuple(col for col in self.columns if col in fields))
+
+        cached = self._records.get(index)
+        record = cached if cached is not None else self.default.copy()
+        record.update(fields)
+        record = self._store(index, record)
+        if self.write_behind and (dirty := self._dirty.get(index)):
+            dirty.difference_update(fields)
+            for key in fields:
+                self._deltas.get(index, {}).pop(key, None)
+
+        val = self._key(index) + tuple(record[col] for col in self.columns)
+        async with bot.pool.acquire() as con:
+            row = await con.fetchrow(stmt, *val)
+            if not row and cached is None:
+                # The record already existed but was not cached.
+                row = await con.fetchrow(self._select_one, *self._key(index))
+
+        # The returned row has the stored values of any fields not being set.
+        if row and cached is None:
+            record.update(self._row(row)[1])
+            self._notify(index, record)
+
+    async def flush(self):
+        '''Hands every dirty record to the writer as one batch.'''
+        if not self.write_behind or not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, {}
+        deltas, self._deltas = self._deltas, {}
+        batch = {}
+        for index, keys in dirty.items():
+            if (record := self._records.get(index)) is not None:
+                batch[index] = {key: record[key] for key in keys}, deltas.get(index, {})
+                self._inflight[index] = self._inflight.get(index, 0) + 1
+
+        # Blocks while the queue is full. Updates made in
+        # the meantime keep coalescing into the dirty map.
+        await self._batches.put(batch)
+
+    async def close(self):
+        '''Writes all pending updates and stops the background tasks.'''
+        if self.write_behind:
+            await self.flush()
+            await self._batches.join()
+
+        if self.snapshot:
+            await self.save()
+
+        for task in self._tasks:
+            task.cancel()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._full.clear()
+            await self.flush()
+
+    async def _write_loop(self):
+        while True:
+            batch = await self._batches.get()
+            try:
+                await self._write(batch)
+            except Exception as err:
+                # Dropped connections raise InterfaceError rather than PostgresError.
+                # Whatever failed, the writer must keep running or flushes block forever.
+                ccp.error(f'Failed to flush {len(batch)} records to {self.table}: {err!r}')
+
+                # Mark the records dirty again so the next flush retries them.
+                # Values set since take the place of failed increments.
+                for index, (vals, deltas) in batch.items():
+                    dirty = self._dirty.setdefault(index, set())
+                    dirty.update(vals)
+                    pending = self._deltas.setdefault(index, {})
+                    for key in vals:
+                        pending.pop(key, None)
+                    for key, delta in deltas.items():
+                        if key not in dirty:
+                            pending[key] = pending.get(key, 0) + delta
+            finally:
+                for index in batch:
+                    if (count := self._inflight[index] - 1):
+                        self._inflight[index] = count
+                    else:
+                        del self._inflight[index]
+                self._batches.task_done()
+
+    async def _write(self, batch: dict):
+        # Records that changed the same columns share a statement,
+        # so a batch is usually a single executemany.
+        groups = {}
+        for index, (vals, deltas) in batch.items():
+            keys = tuple(col for col in self.columns if col in vals)
+            incs = tuple(col for col in self.columns if col in deltas)
+            if keys or incs:
+                args = tuple(vals[k] for k in keys) + tuple(deltas[k] for k in incs) + self._key(index)
+                groups.setdefault((keys, incs), []).append(args)
 
         async with bot.pool.acquire() as con:
-            if isinstance(index, Iterable):
-                condition = ' AND '.join(f'{k} = ${i+1}' for i, k in enumerate(self.pk.split(', ')))
-                await con.execute(f'UPDATE {self.table} SET {key} = {val} WHERE {condition}', *index)
-            else:
-                await con.execute(f'UPDATE {self.table} SET {key} = {val} WHERE {self.pk} = $1', index)
+            async with con.transaction():
+                for (keys, incs), args in groups.items():
+                    await con.executemany(self._statement(keys, incs), args)
 
 async def init():
     bot.pool = await asyncpg.create_pool(user='tau', password=config.passwd, database='tau', host='127.0.0.1')
 
-    bot.guilds_ = await Cache('guilds', 'guild_id', utils.guilds_schema, utils._def_guild)
-    bot.users_ = await Cache('users', 'user_id', utils.users_schema, utils._def_user)
-    bot.members = await Cache('members', 'user_id, guild_id', utils.members_schema, utils._def_member)
-    bot.rmenus = await Cache('role_menus', 'guild_id, message_id', utils.role_menus_schema, utils._def_role_menu)
-    bot.ranks = await Cache('ranks', 'guild_id', utils.ranks_schema, utils._def_rank)
-    bot.stars = await Cache('stars', 'message_id', utils.stars_schema, utils._def_star)
-    bot.reminders = await Cache('reminders', 'user_id, time', utils.reminders_schema, utils._def_reminder)
-    bot.tags = await Cache('tags', 'guild_id, name', utils.tags_schema, utils._def_tag)
-    bot.modlog = await Cache('modlog', 'user_id, guild_id', utils.modlog_schema, utils._def_modlog)
+    # Large tables are read on demand and bounded in memory.
+    capacity = getattr(config, 'cache_capacity', 100000)
+
+    # Tables are created and altered before anything reads them.
+    await migrations.migrate(bot.pool)
+
+    # Every table loads concurrently on its own pool connection.
+    start = time.perf_counter()
+    (bot.guilds_, bot.users_, bot.members, bot.rmenus, bot.ranks,
+     bot.stars, bot.tags, bot.modlog) = await asyncio.gather(
+        Cache('guilds', 'guild_id', utils.guilds_schema, utils._def_guild, snapshot=True),
+        Cache('users', 'user_id', utils.users_schema, utils._def_user, lazy=True, capacity=capacity),
+        Cache('members', 'user_id, guild_id', utils.members_schema, utils._def_member, write_behind=True, lazy=True, capacity=capacity,
+              store=lambda: ColumnStore(2, utils.members_dtypes), indexes=('guild_id',)),
+        Cache('role_menus', 'guild_id, message_id', utils.role_menus_schema, utils._def_role_menu, snapshot=True, indexes=('guild_id',)),
+        Cache('ranks', 'guild_id', utils.ranks_schema, utils._def_rank, snapshot=True),
+        Cache('stars', 'message_id', utils.stars_schema, utils._def_star, lazy=True, capacity=capacity),
+        Cache('tags', 'guild_id, name', utils.tags_schema, utils._def_tag, snapshot=True, indexes=('guild_id',)),
+        Cache('modlog', 'user_id, guild_id', utils.modlog_schema, utils._def_modlog, snapshot=True, indexes=('guild_id',))
+    )
+
+    for cache in sorted(bot.caches, key=lambda cache: cache.load_time, reverse=True):
+        mode = 'on demand' if cache.lazy else f'{len(cache.keys())} records'
+        ccp.log('Cached', f'{cache.table} ({mode}) in {cache.load_time*1000:.0f}ms')
+    ccp.log('Cached', f'all tables in {(time.perf_counter()-start)*1000:.0f}ms')
+
+    bot.rankings = ranking.Rankings(bot.pool, bot.members)
+
+    # Outbound HTTP shares one pool of connections.
+    bot.web = web.Client()
+
+    # Images are drawn off the event loop, from assets decoded once.
+    resources.preload()
+    bot.renderer = render.Renderer()
+
+    # Avatars are fetched and cut out once per avatar.
+    bot.avatars = avatars.AvatarCache(bot.web, bot.renderer, getattr(config, 'avatar_cache_size', 256),
+                                      getattr(config, 'avatar_cache_dir', None))
+    bot.cards = render.CardCache(getattr(config, 'card_cache_mb', 64) * 1024 * 1024)
+
+    # Mutes and reminders run from one timer queue.
+    bot.scheduler = scheduler.Scheduler(bot.pool)
+
+    # Plugins add their message stages as they load; commands run last.
+    bot.pipeline = pipeline.Pipeline(bot)
+    bot.pipeline.register('commands', lambda ctx: bot.process_commands(ctx.msg), pipeline.COMMANDS)
 
     # Loads plugins
     files = [f'plugins.{file[:-3]}' for file in os.listdir('plugins') if '__' not in file]
@@ -155,8 +708,9 @@ async def init():
 
     ccp.done()
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init())
+@bot.event
+async def on_message(msg):
+    await bot.pipeline.dispatch(msg)
 
 @bot.event
 async def on_ready():
@@ -171,11 +725,13 @@ async def on_ready():
     bot.url = oauth_url(client_id=bot.user.id, permissions=Permissions(permissions=8))
     ccp.ready(f'URL: \u001b[1m\u001b[34m{bot.url}\u001b[0m')
 
+    # on_ready fires again on every reconnect; the scheduler only starts once.
+    await bot.scheduler.start()
+
     for guild in bot.guilds:
         if guild.id not in bot.guilds_.keys():
-            await bot.guilds_.insert(guild.id)
-            if guild.system_channel:
-                await bot.guilds_.update(guild.id, 'system_channel', guild.system_channel.id)
+            fields = {'system_channel': guild.system_channel.id} if guild.system_channel else {}
+            await bot.guilds_.upsert(guild.id, **fields)
 
         if guild.me.guild_permissions.manage_guild:
             bot.invites_[guild.id] = await guild.invites()
@@ -183,8 +739,13 @@ async def on_ready():
                 vanity = await guild.vanity_invite()
                 bot.invites_[guild.id].append(vanity)
 
-try:
-    bot.run(config.token)
-except:
-    ccp.error('Failed to connect to Discord servers. Check your internet connection.')
-    os._exit(0)
+# Render workers may import this module afresh, and must not start a bot.
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init())
+
+    try:
+        bot.run(config.token)
+    except:
+        ccp.error('Failed to connect to Discord servers. Check your internet connection.')
+        os._exit(0)
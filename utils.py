@@ -2,12 +2,16 @@ import asyncio
 import datetime
 import io
 import time
+from bisect import bisect_right
 
 import discord
+import numpy as np
 from discord import Embed, File
 from discord.ext import commands
 from discord.utils import escape_markdown, find
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+import resources
 
 # Emoji taken from a private emoji server.
 # These must be redefined if you fork, or
@@ -64,6 +68,9 @@ class Color:
 class RoleNotFound(Exception):
     '''Exception: Role could not be found'''
 
+class RendererBusy(Exception):
+    '''Exception: Too many images are already being rendered'''
+
 def is_dm_only(cmd: commands.Command) -> bool:
     res = find(lambda ch: ch.__qualname__.startswith('dm_only'), cmd.checks)
     return res != None
@@ -76,7 +83,7 @@ def display_color(color: discord.Color) -> io.BytesIO:
     im = Image.new('RGB', (1200, 400), color.to_rgb())
     draw = ImageDraw.Draw(im)
 
-    font = ImageFont.truetype('assets/font/Comfortaa-Bold.ttf', 250)
+    font = resources.font(250)
 
     x, y = im.width, im.height
     w, h = font.getsize(str(color))
@@ -164,12 +171,44 @@ def rgb_to_hsv(r: float, g: float, b: float):
 
     return h, s, v
 
-def level(xp):
+def _level(xp):
     return int(((5 ** (2/3)) * (xp ** (2/3))) / 100) + 1
 
-def levelxp(lvl):
+def _levelxp(lvl):
     return int(200 * (lvl - 1) ** 1.5) + 1 if lvl != 1 else 0
 
+def _threshold(lvl):
+    '''Returns the least XP at which `_level` reaches `lvl`.'''
+    xp = int((100 * (lvl - 1)) ** 1.5 / 5)
+    while xp > 0 and _level(xp - 1) >= lvl:
+        xp -= 1
+    while _level(xp) < lvl:
+        xp += 1
+    return xp
+
+# Levels up to _MAX_LEVEL are looked up in tables built from the
+# formulas above, so lookups give exactly the same results.
+_MAX_LEVEL = 10000
+_thresholds = [_threshold(lvl) for lvl in range(1, _MAX_LEVEL+2)]
+_thresholds_array = np.array(_thresholds, np.int64)
+_levelxps = [_levelxp(lvl) for lvl in range(1, _MAX_LEVEL+2)]
+
+def level(xp):
+    if 0 <= xp < _thresholds[-1]:
+        return bisect_right(_thresholds, xp)
+    return _level(xp)
+
+def levels(xps):
+    '''Returns the level of every XP value in an array.'''
+    xps = np.asarray(xps, np.int64)
+    lvls = np.searchsorted(_thresholds_array, xps, side='right')
+    for i in np.flatnonzero((xps < 0) | (xps >= _thresholds[-1])):
+        lvls[i] = _level(int(xps[i]))
+    return lvls
+
+def levelxp(lvl):
+    return _levelxps[lvl-1] if 1 <= lvl <= len(_levelxps) else _levelxp(lvl)
+
 def findrole(id, guild):
     role = guild.get_role(id)
     if not role:
@@ -198,13 +237,13 @@ def parse_time(text):
     return time_, delta
 
 async def before(ctx):
-    if not ctx.bot.users_.get(ctx.author.id) and not ctx.author.bot:
-        await ctx.bot.users_.insert(ctx.author.id)
+    if not ctx.author.bot:
+        await ctx.bot.users_.fetch(ctx.author.id, create=True)
 
     if ctx.guild:
-        for kw in list(ctx.kwargs.values()):
-            if isinstance(kw, discord.Member) and not ctx.bot.users_.get(kw.id):
-                await ctx.bot.users_.insert(kw.id)
+        for arg in ctx.args + list(ctx.kwargs.values()):
+            if isinstance(arg, discord.Member) and not arg.bot:
+                await ctx.bot.users_.fetch(arg.id, create=True)
 
 # Default database values
 
@@ -294,13 +333,18 @@ users_schema = ('user_id bigint PRIMARY KEY, '
 members_schema = ('user_id bigint, '
                   'guild_id bigint, '
                   'xp bigint, '
-                  'muted timestamp')
+                  'muted timestamp, '
+                  'PRIMARY KEY (user_id, guild_id)')
+
+# Array types of the columnar members store
+members_dtypes = {'xp': 'int64', 'muted': 'datetime64[us]'}
 
 role_menus_schema = ('guild_id bigint, '
                      'message_id bigint, '
                      'role_ids bigint[], '
                      'emojis text[], '
-                     'limit_ bigint')
+                     'limit_ bigint, '
+                     'PRIMARY KEY (guild_id, message_id)')
 
 ranks_schema = ('guild_id bigint PRIMARY KEY, '
                 'role_ids bigint[], '
@@ -312,12 +356,14 @@ stars_schema = ('message_id bigint PRIMARY KEY, '
 reminders_schema = ('user_id bigint, '
                     'channel_id bigint, '
                     'time timestamp, '
-                    'reminder text')
+                    'reminder text, '
+                    'PRIMARY KEY (user_id, time)')
 
 tags_schema = ('guild_id bigint, '
                'name text, '
                'embed text, '
-               'content text')
+               'content text, '
+               'PRIMARY KEY (guild_id, name)')
 
 modlog_schema = ('user_id bigint, '
                  'guild_id bigint, '
@@ -0,0 +1,53 @@
+# Tau Copyright 2019-2020 The Apache Software Foundation
+
+import asyncio
+
+import aiohttp
+
+import ccp
+
+# Statuses worth asking again for
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class Client(object):
+    '''An HTTP client shared by the whole bot.
+
+    Connections are kept alive in one pool of at most `limit`, with at most
+    `per_host` to any one host. A request that times out, fails to connect
+    or gets a retryable status is tried again up to `retries` times, waiting
+    twice as long each time.
+    '''
+    def __init__(self, limit: int = 100, per_host: int = 8, timeout: float = 10.0, retries: int = 2):
+        self.retries = retries
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, limit_per_host=per_host),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            raise_for_status=False
+        )
+
+    async def _request(self, method: str, url: str, read, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._session.request(method, url, **kwargs) as res:
+                    if res.status not in _RETRY_STATUSES or attempt == self.retries:
+                        res.raise_for_status()
+                        return await read(res)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                if attempt == self.retries:
+                    raise
+                ccp.error(f'{method} {url} failed: {err!r}')
+
+            await asyncio.sleep(0.5 * 2**attempt)
+
+    async def get(self, url: str, **kwargs) -> bytes:
+        '''Returns the body of a GET request.
+        Raises aiohttp.ClientError if it fails, asyncio.TimeoutError if it takes too long.
+        '''
+        return await self._request('GET', url, lambda res: res.read(), **kwargs)
+
+    async def json(self, url: str, **kwargs) -> any:
+        '''Returns the decoded JSON body of a GET request.'''
+        return await self._request('GET', url, lambda res: res.json(content_type=None), **kwargs)
+
+    async def close(self):
+        await self._session.close()